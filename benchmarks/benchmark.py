@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# Times how the player scales with the size of the library, on synthetic libraries generated by
+# library.py and with the vlc stand-in in this directory, and prints the results as JSON so that
+# they can be compared across versions.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import platform
+import tracemalloc
+import subprocess
+import importlib.util
+from types import SimpleNamespace
+
+import library
+
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATH = os.path.join(BENCHMARKS_DIRECTORY, "..", "mp3-player", "mp3-player.py")
+ORDERS = ["path", "title", "artist", "number", "random", "modified-artist", "modified-number", "distributed-title", "distributed-number"]
+FAVOURITES_RATIO = 10 # one song every FAVOURITES_RATIO is a favourite
+MAX_TRANSITIONS = 2000
+MAX_SONG_STARTS = 200
+SONG_START_BYTES = 64 << 10 # read by the player to start a song
+
+
+def loadPlayer():
+	# the player puts its standard input in cbreak mode in Keyboard.init, so it gets a pseudo terminal,
+	# which is also used to send it keys; "import vlc" finds the stand-in in this directory
+	masterFileDescriptor, slaveFileDescriptor = os.openpty()
+	os.dup2(slaveFileDescriptor, 0)
+	sys.path.insert(0, BENCHMARKS_DIRECTORY)
+
+	spec = importlib.util.spec_from_file_location("mp3player", SCRIPT_PATH)
+	player = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(player)
+	player.Keyboard.init()
+	player.Options.quiet = True
+	return player, masterFileDescriptor
+
+def version():
+	try:
+		return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=BENCHMARKS_DIRECTORY, stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+class Benchmark:
+	def __init__(self, player, keyboardFileDescriptor, repeat):
+		self.player = player
+		self.keyboardFileDescriptor = keyboardFileDescriptor
+		self.repeat = repeat
+		self.results = []
+
+	def measure(self, name, size, function, setup = None, operations = 1):
+		times = []
+		for _ in range(self.repeat):
+			if setup is not None:
+				setup()
+			start = time.perf_counter()
+			function()
+			times.append(time.perf_counter() - start)
+		self.results.append({
+			"name": name,
+			"size": size,
+			"operations": operations,
+			"seconds": min(times),
+			"secondsPerOperation": min(times) / operations,
+		})
+		print("%-32s %8d %12.6f s" % (name, size, min(times)), file=sys.stderr)
+
+	def measureMemory(self, name, size, function):
+		# the memory allocated by function that is still in use when it returns, keeping its result
+		tracemalloc.start()
+		start = tracemalloc.get_traced_memory()[0]
+		result = function()
+		allocated = tracemalloc.get_traced_memory()[0] - start
+		tracemalloc.stop()
+		self.results.append({
+			"name": name,
+			"size": size,
+			"bytes": allocated,
+			"bytesPerSong": allocated / size,
+		})
+		print("%-32s %8d %12d B" % (name, size, allocated), file=sys.stderr)
+		return result
+
+	def run(self, directory, size):
+		player = self.player
+		tagIndexPath = os.path.join(directory, player.TAG_INDEX_FILENAME)
+		def removeTagIndex():
+			if os.path.exists(tagIndexPath):
+				os.remove(tagIndexPath)
+
+		self.measure("playlist-load-path", size, lambda: player.Playlist(directory, "path").load())
+		self.measure("playlist-load-cold-index", size, lambda: player.Playlist(directory, "artist").load(), setup=removeTagIndex)
+		self.measure("playlist-load-warm-index", size, lambda: player.Playlist(directory, "artist").load())
+		def loadTagged():
+			playlist = player.Playlist(directory, "artist")
+			playlist.load()
+			player.Scanner.map(lambda song: song.readTags(player.TagIndex.FIELDS), playlist.songs)
+			return playlist
+		self.measureMemory("memory-songs", size, loadTagged)
+
+		playlist = player.Playlist(directory, "path")
+		playlist.load()
+		player.Scanner.map(lambda song: song.readTags(player.TagIndex.FIELDS), playlist.songs)
+		for order in ORDERS:
+			sortedPlaylist = SimpleNamespace(playOrder=player.Order.cast(order), songs=None)
+			def copySongs():
+				sortedPlaylist.songs = playlist.songs[:]
+			self.measure("sort-" + order, size, lambda: player.sortPlaylist(sortedPlaylist), setup=copySongs)
+
+		with open(player.FAVOURITES_FILENAME, "w") as favouritesFile:
+			favouritesFile.write("%s\n0\n" % player.Order.trackNumber.value)
+			favouritesFile.write("\n".join(os.path.abspath(song.path) for song in playlist.songs[::FAVOURITES_RATIO]))
+		self.measure("favourites-setup", size, lambda: player.Favourites.setup(None, None))
+		self.measure("is-favourite", size, lambda: [player.Favourites.isFavourite(song) for song in playlist.songs], operations=size)
+
+		hashesPath = os.path.abspath(player.HASHES_FILENAME)
+		def removeHashes():
+			player.Duplicates.cache, player.Duplicates.changed = {}, False
+			if os.path.exists(hashesPath):
+				os.remove(hashesPath)
+		self.measure("duplicates-hash-cold", size, lambda: player.Duplicates.hashes(playlist.songs), setup=removeHashes, operations=size)
+		self.measure("duplicates-hash-cached", size, lambda: player.Duplicates.hashes(playlist.songs), operations=size)
+
+		if hasattr(os, "posix_fadvise"):
+			# songs are dropped from the page cache before every measurement, like after a disk spun down
+			paths = [song.path for song in playlist.songs[:MAX_SONG_STARTS]]
+			buffer = bytearray(player.READ_AHEAD_CHUNK)
+			def readAhead():
+				self.evict(paths)
+				for path in paths:
+					player.ReadAhead.warm(path, buffer)
+			self.measure("song-start-cold", size, lambda: self.startSongs(paths), setup=lambda: self.evict(paths), operations=len(paths))
+			self.measure("song-start-read-ahead", size, lambda: self.startSongs(paths), setup=readAhead, operations=len(paths))
+
+		transitions = min(size, MAX_TRANSITIONS)
+		for gapless in [False, True]:
+			player.Options.gapless = gapless
+			self.measure("transitions" + ("-gapless" if gapless else ""), size,
+				lambda: self.playTransitions(player.Playlist(directory, "path"), transitions), operations=transitions)
+		player.Options.gapless = False
+
+	@staticmethod
+	def evict(paths):
+		for path in paths:
+			with open(path, "rb") as songFile:
+				os.posix_fadvise(songFile.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+	@staticmethod
+	def startSongs(paths):
+		for path in paths:
+			with open(path, "rb") as songFile:
+				songFile.read(SONG_START_BYTES)
+
+	def playTransitions(self, playlist, transitions):
+		# every song ends as soon as it starts, until the last one which is aborted with a key
+		played = [0]
+		def onPlay(path):
+			played[0] += 1
+			if played[0] < transitions:
+				return True
+			os.write(self.keyboardFileDescriptor, b"a")
+			return False
+		vlc = importlib.import_module("vlc")
+		vlc.onPlay = onPlay
+		self.player.PlaylistsPlayer.playPlaylist(playlist)
+		vlc.onPlay = None
+
+
+def main(arguments):
+	argParser = argparse.ArgumentParser(prog="benchmark.py", description="time the player on synthetic libraries and print the results as JSON")
+	argParser.add_argument('-n', '--sizes', type=int, nargs='+', default=[1000, 10000], help="numbers of songs of the libraries to benchmark (defaults to 1000 10000)")
+	argParser.add_argument('-l', '--library-directory', type=str, default=None, help="where to keep the generated libraries, so that they can be reused by later runs (defaults to a temporary directory)")
+	argParser.add_argument('-r', '--repeat', type=int, default=3, help="times every measurement is repeated, keeping the best one (defaults to 3)")
+	argParser.add_argument('-w', '--scan-workers', type=int, default=4, help="scan workers used by the player (defaults to 4)")
+	argParser.add_argument('-o', '--output', type=str, default=None, help="file to write the JSON results to (defaults to standard output)")
+	opts = argParser.parse_args(arguments[1:])
+
+	random.seed(0)
+	player, keyboardFileDescriptor = loadPlayer()
+	player.Scanner.setup(opts.scan_workers)
+	benchmark = Benchmark(player, keyboardFileDescriptor, opts.repeat)
+
+	libraryDirectory = opts.library_directory or tempfile.mkdtemp(prefix="mp3-player-benchmark-")
+	workingDirectory = tempfile.mkdtemp(prefix="mp3-player-benchmark-cwd-")
+	oldWorkingDirectory = os.getcwd()
+	os.chdir(workingDirectory)
+	try:
+		for size in opts.sizes:
+			directory = os.path.join(os.path.abspath(libraryDirectory), "library-%d" % size) + "/"
+			if not os.path.isdir(directory):
+				print("Generating library of %d songs in \"%s\"" % (size, directory), file=sys.stderr)
+				library.generate(directory, size)
+			benchmark.run(directory, size)
+	finally:
+		os.chdir(oldWorkingDirectory)
+		shutil.rmtree(workingDirectory)
+		if opts.library_directory is None:
+			shutil.rmtree(libraryDirectory)
+
+	results = json.dumps({
+		"version": version(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"scanWorkers": opts.scan_workers,
+		"results": benchmark.results,
+	}, indent=4)
+	if opts.output is None:
+		print(results)
+	else:
+		with open(opts.output, "w") as outputFile:
+			outputFile.write(results + "\n")
+
+if __name__ == '__main__':
+	main(sys.argv)
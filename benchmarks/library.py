@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Generates synthetic libraries of MP3 files, with ID3v2.3 or ID3v2.4 tags that may miss some
+# fields, contain cover art or be missing altogether. The audio is a single silent MPEG frame.
+
+import os
+import random
+import argparse
+
+AUDIO = b"\xff\xfb\x90\x00" + bytes(413)
+WORDS = ["love", "night", "blue", "fire", "road", "heart", "rain", "summer", "dream", "city",
+	"light", "river", "gold", "wild", "moon", "song", "home", "echo", "storm", "paper"]
+
+def syncsafe(value):
+	return bytes([(value >> 21) & 0x7f, (value >> 14) & 0x7f, (value >> 7) & 0x7f, value & 0x7f])
+
+def frame(version, frameId, data):
+	size = syncsafe(len(data)) if version == 4 else len(data).to_bytes(4, "big")
+	return frameId + size + b"\x00\x00" + data
+
+def textFrame(version, frameId, text):
+	if version == 4:
+		return frame(version, frameId, b"\x03" + text.encode("utf-8"))
+	return frame(version, frameId, b"\x01" + text.encode("utf-16"))
+
+def id3Tag(version, title, artist, trackNumber, coverSize):
+	frames = b""
+	if title is not None:
+		frames += textFrame(version, b"TIT2", title)
+	if artist is not None:
+		frames += textFrame(version, b"TPE1", artist)
+	if trackNumber is not None:
+		frames += textFrame(version, b"TRCK", str(trackNumber))
+	if coverSize > 0:
+		frames += frame(version, b"APIC", b"\x00image/jpeg\x00\x03\x00" + bytes(coverSize))
+	padding = bytes(256)
+	return b"ID3" + bytes([version, 0, 0]) + syncsafe(len(frames) + len(padding)) + frames + padding
+
+def generate(directory, count, seed = 0, subdirectories = 0):
+	generator = random.Random(seed)
+	artists = ["%s %s" % (generator.choice(WORDS).title(), generator.choice(WORDS).title()) for _ in range(max(1, count // 10))]
+	os.makedirs(directory, exist_ok=True)
+	for subdirectory in range(subdirectories):
+		os.makedirs(os.path.join(directory, "disc%d" % subdirectory), exist_ok=True)
+
+	for i in range(count):
+		filename = "%s-%07d.mp3" % (generator.choice(WORDS), i)
+		if subdirectories > 0 and i % 2 == 1:
+			filename = os.path.join("disc%d" % (i % subdirectories), filename)
+
+		with open(os.path.join(directory, filename), "wb") as file:
+			if generator.random() >= 0.05:
+				file.write(id3Tag(
+					generator.choice([3, 4]),
+					" ".join(generator.choice(WORDS) for _ in range(generator.randint(1, 4))).title() if generator.random() < 0.9 else None,
+					generator.choice(artists) if generator.random() < 0.8 else None,
+					generator.randint(1, 30) if generator.random() < 0.7 else None,
+					generator.choice([20000, 60000]) if generator.random() < 0.05 else 0))
+			file.write(AUDIO)
+
+if __name__ == '__main__':
+	argParser = argparse.ArgumentParser(prog="library.py", description="generate a synthetic library of tagged MP3 files")
+	argParser.add_argument('-s', '--seed', type=int, default=0, help="seed of the random generator (defaults to 0)")
+	argParser.add_argument('-d', '--subdirectories', type=int, default=0, help="put half of the songs in this many subdirectories (defaults to 0)")
+	argParser.add_argument('directory', metavar='DIRECTORY', help="directory to generate the songs in")
+	argParser.add_argument('count', metavar='COUNT', type=int, help="number of songs to generate")
+	args = argParser.parse_args()
+	generate(args.directory, args.count, args.seed, args.subdirectories)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Measures how long the script takes to start, by running "mp3-player.py --help" (which exits right
+# after parsing arguments) in fresh interpreters, and prints the results as JSON. Run it on different
+# versions of the script (see --script) to compare them.
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATH = os.path.join(BENCHMARKS_DIRECTORY, "..", "mp3-player", "mp3-player.py")
+
+
+def run(command, environment):
+	# older versions set up the terminal when imported, so they get a pseudo terminal as stdin
+	masterFileDescriptor, slaveFileDescriptor = os.openpty()
+	try:
+		start = time.perf_counter()
+		completed = subprocess.run(command, stdin=slaveFileDescriptor, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=environment)
+		seconds = time.perf_counter() - start
+	finally:
+		os.close(masterFileDescriptor)
+		os.close(slaveFileDescriptor)
+	if completed.returncode != 0:
+		raise RuntimeError("%s failed: %s" % (command, completed.stderr.decode().strip()))
+	return seconds
+
+def importTimes(script, environment):
+	# the modules imported at startup that took the longest, as reported by python -X importtime
+	masterFileDescriptor, slaveFileDescriptor = os.openpty()
+	try:
+		completed = subprocess.run([sys.executable, "-X", "importtime", script, "--help"],
+			stdin=slaveFileDescriptor, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=environment)
+	finally:
+		os.close(masterFileDescriptor)
+		os.close(slaveFileDescriptor)
+	modules = []
+	for line in completed.stderr.decode().splitlines():
+		if line.startswith("import time:") and "|" in line:
+			_, cumulative, name = line[len("import time:"):].split("|")
+			if cumulative.strip().isdigit() and not name.startswith("  "):
+				modules.append((int(cumulative) / 1e6, name.strip()))
+	return [{"module": name, "seconds": seconds} for seconds, name in sorted(modules, reverse=True)[:10]]
+
+def main(arguments):
+	argParser = argparse.ArgumentParser(prog="startup.py", description="time how long the script takes to start and print the results as JSON")
+	argParser.add_argument('-s', '--script', type=str, default=SCRIPT_PATH, help="path to the mp3-player.py to measure (defaults to the one in this repository)")
+	argParser.add_argument('-r', '--repeat', type=int, default=20, help="times the script is started (defaults to 20)")
+	argParser.add_argument('--stand-in', action='store_true', default=False, help="use the vlc stand-in in this directory instead of python-vlc")
+	argParser.add_argument('-o', '--output', type=str, default=None, help="file to write the JSON results to (defaults to standard output)")
+	opts = argParser.parse_args(arguments[1:])
+
+	environment = dict(os.environ)
+	if opts.stand_in:
+		environment["PYTHONPATH"] = os.pathsep.join([BENCHMARKS_DIRECTORY] + ([environment["PYTHONPATH"]] if "PYTHONPATH" in environment else []))
+
+	interpreter = [run([sys.executable, "-c", "pass"], environment) for _ in range(opts.repeat)]
+	script = [run([sys.executable, opts.script, "--help"], environment) for _ in range(opts.repeat)]
+	results = json.dumps({
+		"script": os.path.abspath(opts.script),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"repeat": opts.repeat,
+		# starting an empty interpreter, to be subtracted from the times of the script
+		"interpreterSeconds": {"min": min(interpreter), "median": sorted(interpreter)[len(interpreter) // 2]},
+		"helpSeconds": {"min": min(script), "median": sorted(script)[len(script) // 2]},
+		"slowestImports": importTimes(opts.script, environment),
+	}, indent=4)
+
+	if opts.output is None:
+		print(results)
+	else:
+		with open(opts.output, "w") as outputFile:
+			outputFile.write(results + "\n")
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -0,0 +1,71 @@
+# Stand-in for the python-vlc module, so that benchmarks can run headless and without libvlc.
+# Songs end as soon as they are played, unless onPlay (called every time a song starts) returns False.
+
+onPlay = None
+
+class State:
+	NothingSpecial = 0
+	Opening = 1
+	Buffering = 2
+	Playing = 3
+	Paused = 4
+	Stopped = 5
+	Ended = 6
+	Error = 7
+
+class EventType:
+	MediaPlayerPlaying = 260
+	MediaPlayerEndReached = 265
+	MediaPlayerEncounteredError = 266
+
+class MediaParseFlag:
+	local = 0
+
+class EventManager:
+	def __init__(self):
+		self.callbacks = {}
+	def event_attach(self, eventType, callback, *args):
+		self.callbacks[eventType] = (callback, args)
+	def fire(self, eventType):
+		if eventType in self.callbacks:
+			callback, args = self.callbacks[eventType]
+			callback(None, *args)
+
+class Media:
+	def __init__(self, path):
+		self.path = path
+	def parse_with_options(self, flags, timeout):
+		return 0
+	def get_mrl(self):
+		return self.path
+
+class MediaPlayer:
+	def __init__(self, path = None):
+		self.media = None if path is None else Media(path)
+		self.state = State.NothingSpecial
+		self.eventManager = EventManager()
+	def event_manager(self):
+		return self.eventManager
+	def set_media(self, media):
+		self.media = media
+	def get_state(self):
+		return self.state
+
+	def play(self):
+		self.state = State.Playing
+		self.eventManager.fire(EventType.MediaPlayerPlaying)
+		if onPlay is not None and not onPlay(self.media.path):
+			return 0
+		self.state = State.Ended
+		self.eventManager.fire(EventType.MediaPlayerEndReached)
+		return 0
+	def pause(self):
+		pass
+	def stop(self):
+		self.state = State.Stopped
+
+class Instance:
+	def media_new(self, path):
+		return Media(path)
+	def media_player_new(self):
+		return MediaPlayer()
@@ -1,37 +1,71 @@
 #!/usr/bin/env python3
 
 #os
-import platform
-OS_NAME = platform.system()
+import os
+OS_NAME = "Windows" if os.name == "nt" else os.uname().sysname
 OS_WINDOWS = "Windows"
 OS_LINUX = "Linux"
 
-#music playing
-import vlc
-
 #file handling
-import os
 import fileinput
-from mutagen.easyid3 import EasyID3
+import json
+import zlib
+from array import array
 
 #misc
 import random
-from time import sleep
+from time import sleep, monotonic, perf_counter, time
 import sys
 from enum import Enum, Flag
 import argparse
 import math
+import bisect
+import atexit
+import shutil
+import threading
 
 
 SETTINGS_FILENAME = "mp3-player-settings.txt"
 DIRECTORIES_FILENAME = "mp3-player-directories.txt"
 FAVOURITES_FILENAME = "mp3-player-favourites.txt"
+FAVOURITES_JOURNAL_FILENAME = "mp3-player-favourites-journal.txt"
+FAVOURITES_POSITION_FILENAME = "mp3-player-favourites-position.txt"
+FAVOURITES_JOURNAL_MAX_LENGTH = 256
+RESCAN_INTERVAL = 10 # seconds
+PROFILE_FILENAME = "mp3-player-profile.json"
+CATALOG_FILENAME = "mp3-player-catalog.sqlite"
+TAG_INDEX_FILENAME = "mp3-player-tags.json"
+ORDER_FILENAME = "mp3-player-order.bin"
+KEY_REPEAT_WINDOW = 0.1
+SEARCH_RESULTS = 10
+EXPORT_FILENAME = "mp3-player-export.m3u8"
+MERGED_SETTINGS_FILENAME = "mp3-player-merged-settings.txt"
+PLAYLIST_FILE_EXTENSIONS = [".m3u", ".m3u8"]
+CHECKPOINT_INTERVAL = 30
+READ_AHEAD_SONGS = 2
+READ_AHEAD_BYTES = 2 << 20
+READ_AHEAD_CHUNK = 256 << 10
+READ_AHEAD_REMEMBERED = 64
+HISTORY_FILENAME = "mp3-player-history.json"
+HISTORY_JOURNAL_FILENAME = "mp3-player-history-journal.txt"
+HISTORY_JOURNAL_MAX_LENGTH = 1024
+HISTORY_RECENCY = 7 * 24 * 60 * 60 # seconds
+HISTORY_MIN_RECENCY_WEIGHT = 0.05
+HISTORY_FAVOURITE_WEIGHT = 2
+HASHES_FILENAME = "mp3-player-hashes.json"
+DUPLICATES_MIN_PROCESS_HASHES = 64
+CONTROL_SOCKET_FILENAME = "mp3-player-control.sock"
+CONTROL_MAX_BUFFERED = 1 << 20 # bytes of notifications a client can fall behind by
+CONTROL_MAX_PENDING = 1024 # commands received but not handled yet by the playback loop
 
 PATH_ORDER_CODES = ["0", "p", "path"]
 TITLE_ORDER_CODES = ["1", "t", "title", "name"]
 ARTIST_ORDER_CODES = ["2", "a", "artist", "author"]
 TRACK_NUMBER_ORDER_CODES = ["3", "n", "number", "tracknumber"]
 RANDOM_ORDER_CODES = ["4", "r", "random"]
+SEEDED_RANDOM_ORDER_CODES = ["5", "s", "shuffle", "seeded"]
+LISTED_ORDER_CODES = ["6", "l", "listed"]
+WEIGHTED_ORDER_CODES = ["7", "w", "weighted"]
 MODIFIED_ORDER_CODES = ["m", "modified"]
 DISTRIBUTED_ORDER_CODES = ["d", "distributed"]
 class Order(Flag):
@@ -42,6 +76,9 @@ class Order(Flag):
 	random = 16
 	modified = 32
 	distributed = 64
+	seededRandom = 128
+	listed = 256
+	weighted = 512
 
 	none = 0
 	default = trackNumber
@@ -61,11 +98,14 @@ class Order(Flag):
 				modifier = cls.none
 				order = playOrder
 
-			if   order in PATH_ORDER_CODES:         return cls.alphabetical | modifier
+			if   order in PATH_ORDER_CODES:         return cls.path | modifier
 			elif order in TITLE_ORDER_CODES:        return cls.title | modifier
 			elif order in ARTIST_ORDER_CODES:       return cls.artist | modifier
 			elif order in TRACK_NUMBER_ORDER_CODES: return cls.trackNumber | modifier
 			elif order in RANDOM_ORDER_CODES:       return cls.random | modifier
+			elif order in SEEDED_RANDOM_ORDER_CODES: return cls.seededRandom | modifier
+			elif order in LISTED_ORDER_CODES:       return cls.listed | modifier
+			elif order in WEIGHTED_ORDER_CODES:     return cls.weighted | modifier
 			else:
 				try:
 					return Order(int(playOrder))
@@ -73,11 +113,36 @@ class Order(Flag):
 					return None
 		return None
 	@classmethod
+	def toCode(cls, playOrder):
+		# the inverse of cast(), used to save play orders: the values of the flags are not used since
+		# cast() reads single digits as the order codes above
+		if   playOrder & cls.modified:    code = MODIFIED_ORDER_CODES[0] + "-"
+		elif playOrder & cls.distributed: code = DISTRIBUTED_ORDER_CODES[0] + "-"
+		else:                             code = ""
+		if   playOrder & cls.path:         return code + PATH_ORDER_CODES[1]
+		elif playOrder & cls.title:        return code + TITLE_ORDER_CODES[1]
+		elif playOrder & cls.artist:       return code + ARTIST_ORDER_CODES[1]
+		elif playOrder & cls.trackNumber:  return code + TRACK_NUMBER_ORDER_CODES[1]
+		elif playOrder & cls.random:       return code + RANDOM_ORDER_CODES[1]
+		elif playOrder & cls.seededRandom: return code + SEEDED_RANDOM_ORDER_CODES[1]
+		elif playOrder & cls.listed:       return code + LISTED_ORDER_CODES[1]
+		elif playOrder & cls.weighted:     return code + WEIGHTED_ORDER_CODES[1]
+		return str(playOrder.value)
+	@classmethod
+	def tagFields(cls, playOrder):
+		if   playOrder & cls.random:       return []
+		elif playOrder & cls.seededRandom: return []
+		elif playOrder & cls.weighted:     return []
+		elif playOrder & cls.title:       return ["title"]
+		elif playOrder & cls.artist:      return ["artist"]
+		elif playOrder & cls.trackNumber: return ["tracknumber"]
+		else:                             return []
+	@classmethod
 	def toString(cls, playOrder):
 		if playOrder & cls.modified:
-			return str(playOrder)[15:].replace('N', " n") + " with variations"
+			return str(playOrder)[15:].replace('N', " n").replace('R', " r") + " with variations"
 		else:
-			return str(playOrder)[6:].replace('N', " n")
+			return str(playOrder)[6:].replace('N', " n").replace('R', " r")
 
 ABORT_KEYS = ['a', 'e', 'q']
 SAVE_KEYS = ['s']
@@ -88,80 +153,147 @@ PREV_SONG_KEYS = ['[A', '[D']
 NEXT_PLAYLIST_KEYS = ['[6']
 PREV_PLAYLIST_KEYS = ['[5']
 FAVOURITE_KEYS = ['f', '+', '*']
+EXPORT_KEYS = ['x']
+SEARCH_KEYS = ['/']
+# commands accepted by ControlServer, which turns them into the keys with the same effect
+CONTROL_COMMANDS = {
+	"pause": PAUSE_KEYS[0],
+	"next": NEXT_SONG_KEYS[0],
+	"prev": PREV_SONG_KEYS[0],
+	"next-playlist": NEXT_PLAYLIST_KEYS[0],
+	"prev-playlist": PREV_PLAYLIST_KEYS[0],
+	"restart": RESTART_KEYS[0],
+	"favourite": FAVOURITE_KEYS[0],
+	"export": EXPORT_KEYS[0],
+	"save": SAVE_KEYS[0],
+	"abort": ABORT_KEYS[0],
+}
 
 
 class Options:
 	verbose = False
 	quiet = False
+	preloadPlaylists = False
+	recursive = False
+	keepOrder = False
+	gapless = False
+	keyRepeatWindow = KEY_REPEAT_WINDOW
 	limitToConsoleWidth = False
-	consoleWidth = int(os.popen('stty size', 'r').read().split()[1])
+	consoleWidth = 80
 	playlists = []
 
 	argParser = argparse.ArgumentParser(prog="mp3-player.py")
 	argParser.add_argument('-q', '--quiet', action='store_true', default=False, help="do not print anything")
 	argParser.add_argument('-v', '--verbose', action='store_true', default=False, help="print more debug information")
 	argParser.add_argument('-w', '--limit-to-console-width', action='store_true', default=False, help="print to the console only part of the output so that it can fit in the console width")
-	argParser.add_argument('-o', '--favourites-play-order', type=str, default=None, help="favourites play order. Must match [m-|modified-|d-|distributed-](p|path|t|title|a|artist|n|number|tracknumber|r|random)")
+	argParser.add_argument('-o', '--favourites-play-order', type=str, default=None, help="favourites play order. Must match [m-|modified-|d-|distributed-](p|path|t|title|a|artist|n|number|tracknumber|r|random|s|shuffle|seeded|l|listed|w|weighted)")
 	argParser.add_argument('-s', '--favourites-start-song', type=int, default=None, help="favourites start index")
-	argParser.add_argument('playlists', nargs='*', metavar='DIRECTORIES', help="playlists to play (DIRECTORY) starting from INDEX (defaults to 0). FORMAT must match [m|modified]-(p|path|t|title|a|artist|n|number|tracknumber|r|random) (defaults to random). Formatted this way: DIRECTORY [FORMAT] [INDEX] - ... - DIRECTORY [FORMAT] [INDEX]")
+	argParser.add_argument('--rebuild-tag-index', action='store_true', default=False, help="ignore the saved tag indices and read the ID3 tags of every song again")
+	argParser.add_argument('-g', '--gapless', action='store_true', default=False, help="use a single player for all songs and prepare the next song while the current one is playing, to reduce the gap between songs")
+	argParser.add_argument('-r', '--recursive', action='store_true', default=False, help="also look for songs in the subdirectories of every directory")
+	argParser.add_argument('-k', '--keep-order', action='store_true', default=False, help="when saving, also save the order songs are being played in, so that directories whose songs did not change resume from the same song in the same order, even if it is random")
+	argParser.add_argument('--preload-playlists', action='store_true', default=False, help="load all playlists in the background once the first one is playing, instead of loading each one only when it is first played")
+	argParser.add_argument('--scan-workers', type=int, default=4, help="number of songs and playlists whose ID3 tags are read at the same time while loading (defaults to 4, 1 disables concurrent loading)")
+	argParser.add_argument('--verify-tag-index', action='store_true', default=False, help="read the ID3 tags of every song again and report saved tag index entries that were out of date")
+	argParser.add_argument('--catalog', nargs='?', const=CATALOG_FILENAME, default=None, metavar='FILE', help="keep the songs of every directory, with their tags and sort keys, in the SQLite database FILE, so that unchanged directories are loaded already sorted without being scanned (defaults to \"%s\")" % CATALOG_FILENAME)
+	argParser.add_argument('--profile', nargs='?', const=PROFILE_FILENAME, default=None, metavar='FILE', help="measure how long loading and playing take and write a JSON report to FILE when exiting (defaults to \"%s\")" % PROFILE_FILENAME)
+	argParser.add_argument('--profile-interval', type=float, default=0, metavar='SECONDS', help="when profiling, also print a line with the playback latencies every SECONDS seconds")
+	argParser.add_argument('--checkpoint-interval', type=float, default=CHECKPOINT_INTERVAL, metavar='SECONDS', help="save the position of the playlists that changed at most every SECONDS seconds while playing, so that it is not lost on a crash (defaults to %d, 0 saves only when exiting with the save key)" % CHECKPOINT_INTERVAL)
+	argParser.add_argument('--key-repeat-window', type=float, default=KEY_REPEAT_WINDOW, metavar='SECONDS', help="next and previous song keys pressed within SECONDS seconds of each other are added up and skip all the songs at once (defaults to %g, 0 only adds up keys that were pressed before the skip was handled)" % KEY_REPEAT_WINDOW)
+	argParser.add_argument('--read-ahead', type=int, default=READ_AHEAD_SONGS, metavar='SONGS', help="read the beginning of the next SONGS songs (and of the next song of the next playlist) in the background, so that they do not stall when they start even if they are on a slow or sleeping disk (defaults to %d, 0 disables reading ahead)" % READ_AHEAD_SONGS)
+	argParser.add_argument('--merge', nargs='?', const="", default=None, metavar='ORDER', help="also play all the playlists merged into a single one, sorted by ORDER, which must be a path, title, artist or track number order (defaults to the order saved in \"%s\" or to track number)" % MERGED_SETTINGS_FILENAME)
+	argParser.add_argument('--duplicates', choices=["skip", "collapse"], default=None, help="find songs with the same audio in different files (e.g. in more directories), comparing hashes of their audio data that are cached in \"%s\". With \"skip\" songs whose audio was already played are skipped, with \"collapse\" only the first of the same songs is kept in every playlist when loading it. Favourites with the same audio count as the same song, but all their files are kept in \"%s\", and removing one removes all of them" % (HASHES_FILENAME, FAVOURITES_FILENAME))
+	argParser.add_argument('--control-socket', nargs='?', const=CONTROL_SOCKET_FILENAME, default=None, metavar='PATH', help="also accept commands (%s) from any number of clients connected to the Unix domain socket at PATH, one per line, and send them a JSON line whenever the song, the playlist, the pause state or the favourites change (defaults to \"%s\")" % (", ".join(CONTROL_COMMANDS), CONTROL_SOCKET_FILENAME))
+	argParser.add_argument('playlists', nargs='*', metavar='DIRECTORIES', help="playlists to play (DIRECTORY or M3U/M3U8 file) starting from INDEX (defaults to 0). FORMAT must match [m|modified]-(p|path|t|title|a|artist|n|number|tracknumber|r|random|s|shuffle|seeded|l|listed|w|weighted) (defaults to random). Formatted this way: DIRECTORY [FORMAT] [INDEX] - ... - DIRECTORY [FORMAT] [INDEX]")
 
 	@staticmethod
 	def parseArgsList(args, allArgs):
-		try:
-			if len(args) == 0:
-				return None
-			elif len(args) == 1:
-				return Playlist(args[0])
-			elif len(args) == 2:
-				return Playlist(args[0], args[1])
-			elif len(args) == 3:
-				return Playlist(args[0], args[1], args[2])
-			else:
-				raise RuntimeError("Invalid arguments (list of arguments \"%s\" too long): \"%s\"" % (args, allArgs))
-		except Playlist.EmptyDirectory as e:
-			log(LogLevel.warning, e.what())
+		if len(args) == 0:
 			return None
+		playlistClass = M3uPlaylist if M3uPlaylist.isPlaylistFile(args[0]) else Playlist
+		if len(args) == 1:
+			return playlistClass(args[0])
+		elif len(args) == 2:
+			return playlistClass(args[0], args[1])
+		elif len(args) == 3:
+			return playlistClass(args[0], args[1], args[2])
+		else:
+			raise RuntimeError("Invalid arguments (list of arguments \"%s\" too long): \"%s\"" % (args, allArgs))
 
 	@classmethod
 	def parse(cls, arguments):
 		arguments = arguments[1:]
+		start = perf_counter()
 		opts = vars(cls.argParser.parse_args(arguments))
+		if opts['profile'] is not None:
+			Profiler.setup(opts['profile'], opts['profile_interval'])
+			Profiler.record("parseArguments", perf_counter() - start)
 		cls.quiet = opts['quiet']
 		cls.verbose = opts['verbose']
 		cls.limitToConsoleWidth = opts['limit_to_console_width']
+		if cls.limitToConsoleWidth:
+			cls.consoleWidth = shutil.get_terminal_size((cls.consoleWidth, 24)).columns
+		cls.preloadPlaylists = opts['preload_playlists']
+		cls.recursive = opts['recursive']
+		cls.keepOrder = opts['keep_order']
+		cls.gapless = opts['gapless']
+		if opts['key_repeat_window'] < 0:
+			raise RuntimeError("Invalid key repeat window \"%s\": must not be negative" % opts['key_repeat_window'])
+		cls.keyRepeatWindow = opts['key_repeat_window']
+		TagIndex.rebuild = opts['rebuild_tag_index']
+		TagIndex.verify = opts['verify_tag_index']
+		if opts['scan_workers'] < 1:
+			raise RuntimeError("Invalid number of scan workers \"%s\": must be at least 1" % opts['scan_workers'])
+		Scanner.setup(opts['scan_workers'])
+		if opts['checkpoint_interval'] < 0:
+			raise RuntimeError("Invalid checkpoint interval \"%s\": must not be negative" % opts['checkpoint_interval'])
+		Settings.setup(opts['checkpoint_interval'])
+		if opts['read_ahead'] < 0:
+			raise RuntimeError("Invalid number of songs to read ahead \"%s\": must not be negative" % opts['read_ahead'])
+		ReadAhead.setup(opts['read_ahead'])
+		if opts['catalog'] is not None:
+			Catalog.setup(opts['catalog'])
+		if opts['control_socket'] is not None:
+			ControlServer.setup(opts['control_socket'])
 
 		favouritesPlayOrder = opts['favourites_play_order']
 		favouritesStartSong = opts['favourites_start_song']
 
-		Favourites.setup(favouritesPlayOrder, favouritesStartSong)
+		Duplicates.setup(opts['duplicates'])
+		with Profiler.measure("loadHistory"):
+			History.setup()
+		with Profiler.measure("loadFavourites"):
+			Favourites.setup(favouritesPlayOrder, favouritesStartSong)
 
 		playlistArgs = opts['playlists']
+		argsLists = []
 		if len(playlistArgs) == 0:
+			allArgs = DIRECTORIES_FILENAME
 			try:
 				with open(DIRECTORIES_FILENAME) as directoriesFile:
-					for line in directoriesFile:
-						playlist = cls.parseArgsList(line, DIRECTORIES_FILENAME)
-						if type(playlist) is Playlist:
-							cls.playlists.append(playlist)
-					if len(playlist) == 0:
-						log(LogLevel.warning, "Empty file \"%s\"" % DIRECTORIES_FILENAME)
-			except:
+					argsLists = [line.split() for line in directoriesFile]
+				if len(argsLists) == 0:
+					log(LogLevel.warning, "Empty file \"%s\"" % DIRECTORIES_FILENAME)
+			except FileNotFoundError:
 				log(LogLevel.warning, "No command line arguments and no \"%s\" file found: using current directory" % DIRECTORIES_FILENAME)
-				try: cls.playlists.append(Playlist("./"))
-				except Playlist.EmptyDirectory as e: log(LogLevel.warning, e.what())
+				argsLists = [["./"]]
 		else:
+			allArgs = playlistArgs
 			tmpArgs = []
 			for arg in playlistArgs:
 				if arg == "-":
-					playlist = cls.parseArgsList(tmpArgs, playlistArgs)
-					if type(playlist) is Playlist:
-						cls.playlists.append(playlist)
+					argsLists.append(tmpArgs)
 					tmpArgs = []
 				else:
 					tmpArgs.append(arg)
-			playlist = cls.parseArgsList(tmpArgs, playlistArgs)
-			if type(playlist) is Playlist:
+			argsLists.append(tmpArgs)
+
+		for args in argsLists:
+			playlist = cls.parseArgsList(args, allArgs)
+			if isinstance(playlist, Playlist):
 				cls.playlists.append(playlist)
+		if opts['merge'] is not None and len(cls.playlists) > 0:
+			cls.playlists.append(MergedPlaylist(cls.playlists[:], opts['merge'] or None))
 
 		if len(cls.playlists) == 0 and len(Favourites.songs) == 0:
 			log(LogLevel.error, "No playlists provided and no favourite available")
@@ -177,56 +309,199 @@ class LogLevel(Enum):
 	info = 1,
 	warning = 2,
 	error = 3
+logLock = threading.Lock()
 def log(level, *args, **kwargs):
-	if not Options.quiet:
-		if level == LogLevel.error:
-			print("[error]", *args, **kwargs)
-		else:
-			if Options.limitToConsoleWidth:
-				separator = kwargs.get('sep', " ")
-				end = kwargs.get('end', "\n")
-				newKwargs = {}
-				for key, value in kwargs.items():
-					if key != 'sep' and key != 'end':
-						newKwargs[key] = value
-
-				toPrint = ""
-				if level == LogLevel.debug and Options.verbose:
-					toPrint = "[debug] "
-				elif level == LogLevel.info:
+	with logLock:
+		if not Options.quiet:
+			if level == LogLevel.error:
+				print("[error]", *args, **kwargs)
+			else:
+				if Options.limitToConsoleWidth:
+					separator = kwargs.get('sep', " ")
+					end = kwargs.get('end', "\n")
+					newKwargs = {}
+					for key, value in kwargs.items():
+						if key != 'sep' and key != 'end':
+							newKwargs[key] = value
+
+					toPrint = ""
+					if level == LogLevel.debug and Options.verbose:
+						toPrint = "[debug] "
+					elif level == LogLevel.info:
+						toPrint = ""
+					elif level == LogLevel.warning:
+						toPrint = "[warning] "
+					else:
+						return
+
+					firstTime = True
+					for arg in args:
+						if firstTime:
+							toPrint += arg.__str__()
+						else:
+							toPrint += separator + arg.__str__()
+						firstTime = False
+					toPrint += end
+
+					lines = toPrint.split("\n")
 					toPrint = ""
-				elif level == LogLevel.warning:
-					toPrint = "[warning] "
+					for line in lines:
+						if len(line) > Options.consoleWidth:
+							toPrint += line[:Options.consoleWidth]
+						else:
+							toPrint += line + "\n"
+					if toPrint[-1] == "\n":
+						toPrint = toPrint[:-1]
+
+					print(toPrint, sep="", end="", **newKwargs)
 				else:
-					return
+					if level == LogLevel.debug and Options.verbose:
+						print("[debug]", *args, **kwargs)
+					elif level == LogLevel.info:
+						print(*args, **kwargs)
+					elif level == LogLevel.warning:
+						print("[warning]", *args, **kwargs)
+
+class Profiler:
+	class Timer:
+		def __init__(self, name):
+			self.name = name
+		def __enter__(self):
+			self.start = perf_counter()
+		def __exit__(self, *exception):
+			Profiler.record(self.name, perf_counter() - self.start)
+
+	enabled = False
+	filename = None
+	lock = threading.Lock()
+	startTime = 0
+	# maps the name of every phase to the durations measured for it
+	samples = {}
+	# the latency being measured until VLC starts playing, as (name, start)
+	pendingLatency = None
 
-				firstTime = True
-				for arg in args:
-					if firstTime:
-						toPrint += arg.__str__()
-					else:
-						toPrint += separator + arg.__str__()
-					firstTime = False
-				toPrint += end
-
-				lines = toPrint.split("\n")
-				toPrint = ""
-				for line in lines:
-					if len(line) > Options.consoleWidth:
-						toPrint += line[:Options.consoleWidth]
-					else:
-						toPrint += line + "\n"
-				if toPrint[-1] == "\n":
-					toPrint = toPrint[:-1]
+	@classmethod
+	def setup(cls, filename, interval):
+		cls.enabled = True
+		cls.filename = filename
+		cls.startTime = perf_counter()
+		atexit.register(cls.writeReport)
+		if interval > 0:
+			threading.Thread(target=cls.printStatsPeriodically, args=(interval,), daemon=True).start()
 
-				print(toPrint, sep="", end="", **newKwargs)
-			else:
-				if level == LogLevel.debug and Options.verbose:
-					print("[debug]", *args, **kwargs)
-				elif level == LogLevel.info:
-					print(*args, **kwargs)
-				elif level == LogLevel.warning:
-					print("[warning]", *args, **kwargs)
+	@classmethod
+	def measure(cls, name):
+		return cls.Timer(name)
+	@classmethod
+	def record(cls, name, seconds):
+		if cls.enabled:
+			with cls.lock:
+				cls.samples.setdefault(name, []).append(seconds)
+	@classmethod
+	def startLatency(cls, name):
+		if cls.enabled:
+			cls.pendingLatency = (name, perf_counter())
+	@classmethod
+	def stopLatency(cls):
+		pendingLatency, cls.pendingLatency = cls.pendingLatency, None
+		if pendingLatency is not None:
+			cls.record(pendingLatency[0], perf_counter() - pendingLatency[1])
+
+	@staticmethod
+	def stats(samples):
+		samples = sorted(samples)
+		return {
+			"count": len(samples),
+			"total": sum(samples),
+			"mean": sum(samples) / len(samples),
+			"min": samples[0],
+			"median": samples[len(samples) // 2],
+			"p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+			"max": samples[-1],
+		}
+	@classmethod
+	def report(cls):
+		with cls.lock:
+			return {
+				"seconds": perf_counter() - cls.startTime,
+				"phases": {name: cls.stats(samples) for name, samples in cls.samples.items()},
+			}
+	@classmethod
+	def writeReport(cls):
+		try:
+			with open(cls.filename, "w") as reportFile:
+				json.dump(cls.report(), reportFile, indent=4)
+		except OSError:
+			log(LogLevel.warning, "Unable to write profile report to \"%s\"" % cls.filename)
+	@classmethod
+	def printStatsPeriodically(cls, interval):
+		while 1:
+			sleep(interval)
+			phases = cls.report()["phases"]
+			log(LogLevel.info, "[profile] " + "; ".join(
+				"%s: %d, mean %.1fms, p95 %.1fms" % (name, phases[name]["count"], phases[name]["mean"] * 1000, phases[name]["p95"] * 1000)
+				for name in ["keyToAudio", "trackTransition"] if name in phases))
+
+def writeFileAtomically(filename, content):
+	# the content is written to a temporary file which then replaces the old file, so that the old
+	# file is left untouched if writing is interrupted, e.g. by a crash or a power loss. Content
+	# that is neither str nor bytes is an iterable of lines, which are written as they are generated
+	temporaryFilename = filename + ".tmp"
+	if type(content) is bytes:
+		temporaryFile = open(temporaryFilename, "wb")
+	else:
+		temporaryFile = open(temporaryFilename, "w", errors="surrogateescape")
+	with temporaryFile:
+		if type(content) in [str, bytes]:
+			temporaryFile.write(content)
+		else:
+			temporaryFile.writelines(content)
+		temporaryFile.flush()
+		os.fsync(temporaryFile.fileno())
+	os.replace(temporaryFilename, filename)
+
+class Settings:
+	# playlists mark themselves as dirty when their settings (e.g. the current song) change, and only
+	# dirty ones are written. While playing they are written by a background thread at most once
+	# every checkpoint interval, so that skipping through many songs causes a single write.
+	interval = CHECKPOINT_INTERVAL
+	lock = threading.Lock()
+	writeLock = threading.Lock()
+	dirty = []
+	changed = threading.Event()
+
+	@classmethod
+	def setup(cls, interval):
+		cls.interval = interval
+		if interval > 0:
+			threading.Thread(target=cls.checkpointPeriodically, daemon=True).start()
+
+	@classmethod
+	def markDirty(cls, playlist):
+		with cls.lock:
+			if playlist not in cls.dirty:
+				cls.dirty.append(playlist)
+		cls.changed.set()
+
+	@classmethod
+	def flush(cls):
+		with cls.writeLock:
+			with cls.lock:
+				dirty, cls.dirty = cls.dirty, []
+				cls.changed.clear()
+			for playlist in dirty:
+				try:
+					playlist.writeSettings()
+				except OSError as e:
+					log(LogLevel.warning, "Unable to save settings: %s" % e)
+	@classmethod
+	def checkpointPeriodically(cls):
+		while 1:
+			cls.changed.wait()
+			# waiting for the interval to pass collects all the changes made in the meantime
+			sleep(cls.interval)
+			cls.flush()
+			log(LogLevel.debug, "Saved a checkpoint of the settings")
 
 #keyboard input
 class Event(Enum):
@@ -240,6 +515,8 @@ class Event(Enum):
 	nextPlaylist = 6
 	prevPlaylist = 7
 	favourite = 8
+	export = 9
+	search = 10
 
 	@classmethod
 	def generate(cls, readChar):
@@ -252,11 +529,33 @@ class Event(Enum):
 		elif readChar in NEXT_PLAYLIST_KEYS: return cls.nextPlaylist
 		elif readChar in PREV_PLAYLIST_KEYS: return cls.prevPlaylist
 		elif readChar in FAVOURITE_KEYS:     return cls.favourite
+		elif readChar in EXPORT_KEYS:        return cls.export
+		elif readChar in SEARCH_KEYS:        return cls.search
 		else:                                return cls.none
 
+def splitKeys(chars):
+	# escape sequences become the codes used in the key lists above, e.g. "\x1B[B" (arrow down)
+	# becomes "[B" and "\x1B[6~" (page down) becomes "[6"
+	keys = []
+	i = 0
+	while i < len(chars):
+		if chars[i] == '\x1B' and chars[i+1:i+2] == '[':
+			key = chars[i+1:i+3]
+			i += 3
+			if key[-1:].isdigit() and chars[i:i+1] == '~':
+				i += 1
+		else:
+			key = chars[i]
+			i += 1
+		keys.append(key)
+	return keys
+
 if OS_NAME == OS_WINDOWS:
 	import msvcrt
 	class Keyboard:
+		# keys that were read but not handled yet, since all available input is read at once
+		pending = []
+
 		@classmethod
 		def init(cls):
 			pass
@@ -264,29 +563,46 @@ if OS_NAME == OS_WINDOWS:
 		def hit():
 			return msvcrt.kbhit()
 		@classmethod
+		def wait(cls, playerEvents):
+			# select() only supports sockets on Windows, so the keyboard has to be polled
+			while len(cls.pending) == 0 and not cls.hit() and not playerEvents.hasPending():
+				sleep(0.05)
+		@classmethod
+		def waitForKey(cls, timeout = None):
+			end = None if timeout is None else monotonic() + timeout
+			while len(cls.pending) == 0 and not cls.hit():
+				if end is not None and monotonic() >= end:
+					return False
+				sleep(0.01)
+			return True
+		@classmethod
+		def getKey(cls):
+			if len(cls.pending) == 0:
+				readChars = ""
+				while cls.hit():
+					readChars += sys.stdin.read(1)		#TODO not sure if escape sequences work on windows
+				cls.pending = splitKeys(readChars)
+			return cls.pending.pop(0) if len(cls.pending) > 0 else None
+		@classmethod
 		def getEvent(cls):
-			if cls.hit():
-				readChar = sys.stdin.read(1)
-			else:
-				return Event.none
-
-			while cls.hit():
-				readChar = sys.stdin.read(1)
-			if readChar == '\x1B':				#TODO not sure if this works on windows
-				readChar = sys.stdin.read(1)
-				if readChar == '[':
-					readChar += sys.stdin.read(1)
-
-			return Event.generate(readChar)
+			key = cls.getKey()
+			return Event.none if key is None else Event.generate(key)
+		@classmethod
+		def putBack(cls, key):
+			cls.pending.insert(0, key)
 else:
 	if (OS_NAME != OS_LINUX):
 		log(LogLevel.error, "The operating system \"%s\" may not be supported" % OS_NAME)
-	import termios, atexit, select
+	import termios, select
 	class TerminalSettings:
-		fileDescriptor = sys.stdin.fileno()
-		old = termios.tcgetattr(fileDescriptor)
-		new = old[:3] + [old[3] & ~termios.ICANON & ~termios.ECHO] + old[4:]
+		fileDescriptor = None
+		old = new = None
 
+		@classmethod
+		def load(cls):
+			cls.fileDescriptor = sys.stdin.fileno()
+			cls.old = termios.tcgetattr(cls.fileDescriptor)
+			cls.new = cls.old[:3] + [cls.old[3] & ~termios.ICANON & ~termios.ECHO] + cls.old[4:]
 		@classmethod
 		def setOld(cls):
 			termios.tcsetattr(cls.fileDescriptor, termios.TCSAFLUSH, cls.old)
@@ -294,86 +610,1130 @@ else:
 		def setNew(cls):
 			termios.tcsetattr(cls.fileDescriptor, termios.TCSAFLUSH, cls.new)
 	class Keyboard:
+		# keys that were read but not handled yet, since all available input is read at once
+		pending = []
+		# False when running headless, e.g. as a service, in which case keys come only from ControlServer
+		terminal = True
+
 		@classmethod
 		def init(cls):
+			cls.terminal = sys.stdin.isatty()
+			if not cls.terminal:
+				log(LogLevel.debug, "Standard input is not a terminal: not reading keys from it")
+				return
+			TerminalSettings.load()
 			atexit.register(TerminalSettings.setOld)
 			TerminalSettings.setNew()
-		@staticmethod
-		def hit():
-			return select.select([sys.stdin,],[],[],0.0)[0] != []
+		@classmethod
+		def inputs(cls):
+			inputs = [sys.stdin] if cls.terminal else []
+			if ControlServer.readFileDescriptor is not None:
+				inputs.append(ControlServer.readFileDescriptor)
+			return inputs
+		@classmethod
+		def hit(cls):
+			return select.select(cls.inputs(),[],[],0.0)[0] != []
+		@classmethod
+		def wait(cls, playerEvents):
+			if len(cls.pending) == 0:
+				select.select(cls.inputs() + [playerEvents.readFileDescriptor], [], [])
+		@classmethod
+		def waitForKey(cls, timeout = None):
+			return len(cls.pending) > 0 or select.select(cls.inputs(),[],[],timeout)[0] != []
+		@classmethod
+		def getKey(cls):
+			if len(cls.pending) == 0:
+				cls.pending = ControlServer.takeKeys()
+			if len(cls.pending) == 0:
+				if not cls.terminal or select.select([sys.stdin,],[],[],0.0)[0] == []:
+					return None
+				readChars = os.read(sys.stdin.fileno(), 1024).decode(errors="replace")
+				# the rest of an escape sequence arrives right away, otherwise escape itself was pressed
+				while (readChars[-1:] == '\x1B' or readChars[-2:] == '\x1B[') and select.select([sys.stdin,],[],[],0.05)[0] != []:
+					readChars += os.read(sys.stdin.fileno(), 1024).decode(errors="replace")
+				cls.pending = splitKeys(readChars)
+			return cls.pending.pop(0) if len(cls.pending) > 0 else None
 		@classmethod
 		def getEvent(cls):
-			if cls.hit():
-				readChar = sys.stdin.read(1)
+			key = cls.getKey()
+			return Event.none if key is None else Event.generate(key)
+		@classmethod
+		def putBack(cls, key):
+			cls.pending.insert(0, key)
+
+class ControlServer:
+	# accepts commands from clients connected to a Unix domain socket and sends them notifications,
+	# running an asyncio event loop in its own thread. Commands become keys that wake up the playback
+	# loop through a pipe, just like PlayerEvents, and notifications are handed over to the event
+	# loop without waiting for the clients, so that the playback loop never waits for the clients
+	path = None
+	loop = None
+	server = None
+	clients = set()
+	# the last notification of every kind in STATE_EVENTS, sent to clients when they connect
+	state = {}
+	STATE_EVENTS = ["playlist", "song", "pause"]
+	lock = threading.Lock()
+	pending = []
+	readFileDescriptor = writeFileDescriptor = None
+
+	@classmethod
+	def setup(cls, path):
+		if OS_NAME == OS_WINDOWS:
+			raise RuntimeError("The control socket is not supported on Windows")
+		import asyncio, socket, stat
+		if os.path.exists(path):
+			if not stat.S_ISSOCK(os.stat(path).st_mode):
+				raise RuntimeError("Invalid control socket \"%s\": the file exists and is not a socket" % path)
+			# left behind by a player that crashed, unless another player is still listening on it
+			try:
+				with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+					probe.connect(path)
+				raise RuntimeError("Control socket \"%s\" already in use by another player" % path)
+			except (ConnectionRefusedError, FileNotFoundError):
+				os.remove(path)
+			except OSError as e:
+				raise RuntimeError("Invalid control socket \"%s\": %s" % (path, e))
+
+		cls.path = path
+		cls.readFileDescriptor, cls.writeFileDescriptor = os.pipe()
+		# the event loop must never wait for the playback loop
+		os.set_blocking(cls.writeFileDescriptor, False)
+		cls.loop = asyncio.new_event_loop()
+		try:
+			cls.server = cls.loop.run_until_complete(asyncio.start_unix_server(cls.serve, path))
+		except OSError as e:
+			raise RuntimeError("Unable to listen on control socket \"%s\": %s" % (path, e))
+		threading.Thread(target=cls.loop.run_forever, daemon=True).start()
+		atexit.register(cls.stop)
+		log(LogLevel.debug, "Listening for commands on \"%s\"" % path)
+
+	@classmethod
+	def stop(cls):
+		import asyncio
+		if cls.server is None:
+			return
+		cls.notify("exit")
+		try:
+			asyncio.run_coroutine_threadsafe(cls.close(), cls.loop).result(timeout=1)
+		except Exception as e:
+			log(LogLevel.debug, "Unable to close control socket cleanly: %s" % e)
+		cls.server = None
+		try:
+			os.remove(cls.path)
+		except OSError: pass
+	@classmethod
+	async def close(cls):
+		import asyncio
+		cls.server.close()
+		for writer in list(cls.clients):
+			try:
+				# the notifications already sent, e.g. "exit", are delivered before closing
+				await asyncio.wait_for(writer.drain(), 0.5)
+			except Exception: pass
+			writer.close()
+
+	@classmethod
+	async def serve(cls, reader, writer):
+		cls.clients.add(writer)
+		for event in cls.STATE_EVENTS:
+			if event in cls.state:
+				writer.write(cls.state[event])
+		try:
+			while 1:
+				line = await reader.readline()
+				if not line:
+					break
+				command = line.decode(errors="replace").strip()
+				if command == "":
+					continue
+				elif command == "status":
+					for event in cls.STATE_EVENTS:
+						if event in cls.state:
+							writer.write(cls.state[event])
+					reply = {"reply": command}
+				elif command in CONTROL_COMMANDS:
+					if cls.push(CONTROL_COMMANDS[command]):
+						reply = {"reply": command}
+					else:
+						reply = {"error": "Too many pending commands, \"%s\" was dropped" % command}
+				else:
+					reply = {"error": "Unknown command \"%s\"" % command}
+				writer.write((json.dumps(reply) + "\n").encode())
+				await writer.drain()
+		except (OSError, ValueError):
+			# disconnected, or sent a line that is too long
+			pass
+		finally:
+			cls.clients.discard(writer)
+			writer.close()
+
+	@classmethod
+	def push(cls, key):
+		# returns False if the key was dropped since too many are pending. The pipe holds a single
+		# byte as long as there are pending keys, so writing to it never blocks
+		with cls.lock:
+			if len(cls.pending) >= CONTROL_MAX_PENDING:
+				return False
+			cls.pending.append(key)
+			if len(cls.pending) == 1:
+				try:
+					os.write(cls.writeFileDescriptor, b"\0")
+				except BlockingIOError: pass
+		return True
+	@classmethod
+	def takeKeys(cls):
+		# the keys of the commands received since the last call, oldest first
+		if cls.readFileDescriptor is None:
+			return []
+		with cls.lock:
+			keys = cls.pending
+			if len(keys) > 0:
+				os.read(cls.readFileDescriptor, 1)
+				cls.pending = []
+		return keys
+
+	@classmethod
+	def notify(cls, event, **fields):
+		if cls.server is None:
+			return
+		fields["event"] = event
+		cls.loop.call_soon_threadsafe(cls.broadcast, event, (json.dumps(fields) + "\n").encode())
+	@classmethod
+	def broadcast(cls, event, line):
+		if event in cls.STATE_EVENTS:
+			cls.state[event] = line
+		for writer in list(cls.clients):
+			if writer.transport.get_write_buffer_size() > CONTROL_MAX_BUFFERED:
+				# not reading notifications anymore
+				log(LogLevel.debug, "Disconnecting control client that is not reading notifications")
+				cls.clients.discard(writer)
+				writer.close()
 			else:
-				return Event.none
+				writer.write(line)
 
-			while cls.hit():
-				readChar = sys.stdin.read(1)
-			if readChar == '\x1B':
-				readChar = sys.stdin.read(1)
-				if readChar == '[':
-					readChar += sys.stdin.read(1)
 
-			return Event.generate(readChar)
+class ID3Reader:
+	FRAMES = {
+		"title": [b"TIT2", b"TT2"],
+		"artist": [b"TPE1", b"TP1"],
+		"tracknumber": [b"TRCK", b"TRK"],
+	}
+	ENCODINGS = ["latin-1", "utf-16", "utf-16-be", "utf-8"]
 
-	Keyboard.init()
+	@staticmethod
+	def syncsafe(data):
+		value = 0
+		for byte in data:
+			value = (value << 7) | (byte & 0x7f)
+		return value
+
+	@classmethod
+	def read(cls, path, fields):
+		with Profiler.measure("readTags"):
+			try:
+				tags = cls.readFrames(path, fields)
+				if tags is None:
+					tags = cls.readWithMutagen(path, fields)
+				return tags
+			except:
+				log(LogLevel.debug, "Unable to read ID3 tags for song at \"%s\"" % path)
+				return {field: [] for field in fields}
+
+	@classmethod
+	def readWithMutagen(cls, path, fields):
+		from mutagen.easyid3 import EasyID3
+		songID3 = EasyID3(path)
+		return {field: list(songID3[field]) if field in songID3 else [] for field in fields}
+
+	@classmethod
+	def readFrames(cls, path, fields):
+		# walks through the frame headers of the ID3v2 tag, decoding only the text frames of the
+		# requested fields and seeking over everything else (e.g. cover art). Returns None for
+		# tags this reader does not handle, so that mutagen can be used instead.
+		with open(path, "rb") as file:
+			header = file.read(10)
+			if len(header) < 10 or header[:3] != b"ID3":
+				return None # maybe ID3v1
+			version, flags = header[3], header[5]
+			if version not in [2, 3, 4] or flags & 0x80: # unsynchronisation
+				return None
+
+			tags = {field: [] for field in fields}
+			wanted = {}
+			for field in fields:
+				for frameId in cls.FRAMES[field]:
+					wanted[frameId] = field
+
+			end = 10 + cls.syncsafe(header[6:10])
+			position = 10
+			if flags & 0x40 and version == 3:
+				position += 4 + int.from_bytes(file.read(4), "big")
+			elif flags & 0x40 and version == 4:
+				position += cls.syncsafe(file.read(4))
+
+			frameHeaderSize = 6 if version == 2 else 10
+			while len(wanted) > 0 and position + frameHeaderSize <= end:
+				file.seek(position)
+				frameHeader = file.read(frameHeaderSize)
+				if len(frameHeader) < frameHeaderSize or frameHeader[0] == 0:
+					break # padding
+
+				if version == 2:
+					frameId, frameSize, formatFlags = frameHeader[:3], int.from_bytes(frameHeader[3:6], "big"), 0
+				elif version == 3:
+					frameId, frameSize, formatFlags = frameHeader[:4], int.from_bytes(frameHeader[4:8], "big"), frameHeader[9]
+				else:
+					frameId, frameSize, formatFlags = frameHeader[:4], cls.syncsafe(frameHeader[4:8]), frameHeader[9]
+				position += frameHeaderSize
+
+				if frameId in wanted:
+					if formatFlags != 0: # compressed, encrypted...
+						return None
+					field = wanted[frameId]
+					tags[field] = cls.decodeText(file.read(frameSize))
+					for otherFrameId in cls.FRAMES[field]:
+						wanted.pop(otherFrameId, None)
+				position += frameSize
+
+			return tags
+
+	@classmethod
+	def decodeText(cls, data):
+		if len(data) == 0 or data[0] >= len(cls.ENCODINGS):
+			return []
+		text = data[1:].decode(cls.ENCODINGS[data[0]], errors="replace")
+		# in UTF-16 every value of a multi-value frame has its own BOM
+		return [value.lstrip("\ufeff") for value in text.split("\x00") if value.lstrip("\ufeff") != ""]
+
+class PlayerEvents:
+	class Event(Enum):
+		ended = 0
+		error = 1
+
+	# VLC calls the callbacks from its own threads: they record what happened and wake up the
+	# playback loop, which waits for them and for the keyboard at the same time in Keyboard.wait
+	lock = threading.Lock()
+	pending = []
+	readFileDescriptor = writeFileDescriptor = None
+
+	@classmethod
+	def attach(cls, player):
+		import vlc
+		if cls.readFileDescriptor is None:
+			cls.readFileDescriptor, cls.writeFileDescriptor = os.pipe()
+		eventManager = player.event_manager()
+		eventManager.event_attach(vlc.EventType.MediaPlayerEndReached, cls.push, player, cls.Event.ended)
+		eventManager.event_attach(vlc.EventType.MediaPlayerEncounteredError, cls.push, player, cls.Event.error)
+		if Profiler.enabled:
+			eventManager.event_attach(vlc.EventType.MediaPlayerPlaying, lambda vlcEvent: Profiler.stopLatency())
+	@classmethod
+	def push(cls, vlcEvent, player, event):
+		# the pipe holds a single byte as long as there are pending events, so writing never blocks
+		with cls.lock:
+			cls.pending.append((player, event))
+			if len(cls.pending) == 1:
+				os.write(cls.writeFileDescriptor, b"\0")
+	@classmethod
+	def hasPending(cls):
+		return len(cls.pending) > 0
+	@classmethod
+	def clear(cls):
+		with cls.lock:
+			if len(cls.pending) > 0:
+				os.read(cls.readFileDescriptor, 1)
+				cls.pending = []
+	@classmethod
+	def pop(cls, player):
+		# returns the last event of the provided player, discarding those left by previous players
+		with cls.lock:
+			if len(cls.pending) == 0:
+				return None
+			os.read(cls.readFileDescriptor, 1)
+			events = [event for eventPlayer, event in cls.pending if eventPlayer is player]
+			cls.pending = []
+		return events[-1] if len(events) > 0 else None
+
+class SongPlayer:
+	# in gapless mode a single player is reused for every song and the media of the song that is
+	# going to be played next is prepared (i.e. opened and parsed by VLC) in the background
+	instance = None
+	player = None
+	preparedPath = preparedMedia = None
+
+	@classmethod
+	def play(cls, song):
+		import vlc
+		if not Options.gapless:
+			player = vlc.MediaPlayer(song.path)
+			PlayerEvents.attach(player)
+			player.play()
+			return player
+
+		if cls.player is None:
+			cls.instance = vlc.Instance()
+			cls.player = cls.instance.media_player_new()
+			PlayerEvents.attach(cls.player)
+
+		if cls.preparedPath == song.path:
+			media = cls.preparedMedia
+		else:
+			media = cls.instance.media_new(song.path)
+		cls.preparedPath = cls.preparedMedia = None
+
+		# events of the previous song are not meaningful anymore, since the player is the same
+		PlayerEvents.clear()
+		cls.player.set_media(media)
+		cls.player.play()
+		return cls.player
+	@classmethod
+	def prepare(cls, song):
+		if not Options.gapless or song is None or cls.preparedPath == song.path:
+			return
+		import vlc
+		cls.preparedMedia = cls.instance.media_new(song.path)
+		cls.preparedMedia.parse_with_options(vlc.MediaParseFlag.local, 0)
+		cls.preparedPath = song.path
+
+class ReadAhead:
+	# a background thread reads the beginning of the songs that are going to be played soon, so
+	# that they are already in the page cache when they start, even if they are on a network or on
+	# a disk that spun down. At most READ_AHEAD_BYTES of every song are read, one chunk at a time
+	# into the same buffer, and songs that stopped being upcoming are not read anymore
+	songs = 0
+	lock = threading.Lock()
+	requested = threading.Event()
+	pending = []
+	# the paths that were read recently, from the least recent one
+	warmed = {}
+	# the playlist that is played after the current one, whose next song is read ahead too
+	nextPlaylist = None
+
+	@classmethod
+	def setup(cls, songs):
+		cls.songs = songs
+		if songs > 0:
+			threading.Thread(target=cls.readAheadRequested, daemon=True).start()
+
+	@classmethod
+	def request(cls, playlist):
+		if cls.songs == 0:
+			return
+		songs = playlist.upcoming(cls.songs)
+		if cls.nextPlaylist is not None and cls.nextPlaylist is not playlist and cls.nextPlaylist.isLoaded():
+			songs += cls.nextPlaylist.upcoming(1)
+		with cls.lock:
+			cls.pending = [song.path for song in songs if song.path not in cls.warmed]
+		cls.requested.set()
+
+	@staticmethod
+	def warm(path, buffer):
+		# the kernel is also asked to read ahead, so that it can fetch the whole range at once
+		with open(path, "rb", buffering=0) as songFile:
+			if hasattr(os, "posix_fadvise"):
+				os.posix_fadvise(songFile.fileno(), 0, READ_AHEAD_BYTES, os.POSIX_FADV_WILLNEED)
+			remaining = READ_AHEAD_BYTES
+			while remaining > 0:
+				read = songFile.readinto(buffer)
+				if not read:
+					break
+				remaining -= read
+	@classmethod
+	def readAheadRequested(cls):
+		buffer = bytearray(READ_AHEAD_CHUNK)
+		while 1:
+			cls.requested.wait()
+			with cls.lock:
+				if len(cls.pending) == 0:
+					cls.requested.clear()
+					continue
+				path = cls.pending.pop(0)
+			try:
+				# the time it takes is the stall that would happen when the song starts
+				with Profiler.measure("readAhead"):
+					cls.warm(path, buffer)
+			except OSError as e:
+				log(LogLevel.debug, "Unable to read ahead song at \"%s\": %s" % (path, e))
+			with cls.lock:
+				cls.warmed[path] = None
+				if len(cls.warmed) > READ_AHEAD_REMEMBERED:
+					del cls.warmed[next(iter(cls.warmed))]
+
+class StringColumn:
+	# strings packed one after the other as UTF-8 in a single buffer, so that each one costs its
+	# length plus 12 bytes instead of a whole str object; the lengths of rows without a string are
+	# NOT_READ or MISSING
+	NOT_READ = 0xffffffff
+	MISSING = 0xfffffffe
+
+	def __init__(self):
+		self.buffer = bytearray()
+		self.starts = array("Q")
+		self.lengths = array("I")
+	def __len__(self):
+		return len(self.lengths)
+
+	def append(self, value):
+		if type(value) is int:
+			self.starts.append(0)
+			self.lengths.append(value)
+		else:
+			data = value.encode("utf-8", "surrogatepass")
+			self.starts.append(len(self.buffer))
+			self.lengths.append(len(data))
+			self.buffer += data
+	def __setitem__(self, index, value):
+		# value is either a string or NOT_READ or MISSING
+		if type(value) is int:
+			self.lengths[index] = value
+		else:
+			data = value.encode("utf-8", "surrogatepass")
+			self.starts[index] = len(self.buffer)
+			self.lengths[index] = len(data)
+			self.buffer += data
+	def __getitem__(self, index):
+		# returns the string, or NOT_READ or MISSING
+		length = self.lengths[index]
+		if length >= StringColumn.MISSING:
+			return length
+		start = self.starts[index]
+		return self.buffer[start:start + length].decode("utf-8", "surrogatepass")
+
+class SongStore:
+	# the paths and tags of all songs, in columns indexed by song id: directories and artists are
+	# stored only once and referenced by id, file names and titles are packed in StringColumns and
+	# track numbers in an array. Rows are only ever added, also by the scan workers
+	FIELDS = ["title", "artist", "tracknumber"]
+	NOT_READ = StringColumn.NOT_READ
+	MISSING = StringColumn.MISSING
+	TRACK_NUMBER_NOT_READ = -1 << 63
+	lock = threading.Lock()
+
+	directories = []
+	directoryIds = {}
+	# absolute and normalized directories, by directory id
+	normalizedDirectories = {}
+	songDirectories = array("I")
+	filenames = StringColumn()
+	titles = StringColumn()
+	artists = []
+	artistIds = {}
+	songArtists = array("I")
+	trackNumbers = array("q")
 
+	@classmethod
+	def add(cls, path, tags = None):
+		separator = max(path.rfind("/"), path.rfind(os.sep)) + 1
+		with cls.lock:
+			directoryId = cls.directoryIds.get(path[:separator])
+			if directoryId is None:
+				directoryId = cls.directoryIds[path[:separator]] = len(cls.directories)
+				cls.directories.append(path[:separator])
+			songId = len(cls.songDirectories)
+			cls.songDirectories.append(directoryId)
+			cls.filenames.append(path[separator:])
+			cls.titles.append(cls.NOT_READ)
+			cls.songArtists.append(cls.NOT_READ)
+			cls.trackNumbers.append(cls.TRACK_NUMBER_NOT_READ)
+			if tags is not None:
+				cls.setTagsLocked(songId, tags)
+		return songId
+	@classmethod
+	def addPaths(cls, paths):
+		# like add() without tags for every path, returning the array of the new song ids
+		directories, directoryIds, songDirectories = cls.directories, cls.directoryIds, cls.songDirectories
+		filenames, filenameStarts, filenameLengths = cls.filenames.buffer, cls.filenames.starts, cls.filenames.lengths
+		with cls.lock:
+			firstId = len(songDirectories)
+			encoded = []
+			for path in paths:
+				separator = max(path.rfind("/"), path.rfind(os.sep)) + 1
+				directoryId = directoryIds.get(path[:separator])
+				if directoryId is None:
+					directoryId = directoryIds[path[:separator]] = len(directories)
+					directories.append(path[:separator])
+				songDirectories.append(directoryId)
+				encoded.append(path[separator:].encode("utf-8", "surrogatepass"))
+			start = len(filenames)
+			for data in encoded:
+				filenameStarts.append(start)
+				start += len(data)
+			filenameLengths.extend(array("I", map(len, encoded)))
+			filenames += b"".join(encoded)
+			count = len(songDirectories) - firstId
+			cls.titles.starts.extend(array("Q", bytes(8 * count)))
+			cls.titles.lengths.extend(array("I", [cls.NOT_READ]) * count)
+			cls.songArtists.extend(array("I", [cls.NOT_READ]) * count)
+			cls.trackNumbers.extend(array("q", [cls.TRACK_NUMBER_NOT_READ]) * count)
+		return array("I", range(firstId, firstId + count))
+	@classmethod
+	def setTags(cls, songId, tags):
+		with cls.lock:
+			cls.setTagsLocked(songId, tags)
+	@classmethod
+	def setTagsLocked(cls, songId, tags):
+		# tags maps fields to their values, which are [] for missing fields
+		for field, values in tags.items():
+			if field == "title":
+				cls.titles[songId] = values[0] if len(values) > 0 else cls.MISSING
+			elif field == "artist":
+				if len(values) == 0:
+					cls.songArtists[songId] = cls.MISSING
+				else:
+					artistId = cls.artistIds.get(values[0])
+					if artistId is None:
+						artistId = cls.artistIds[values[0]] = len(cls.artists)
+						cls.artists.append(values[0])
+					cls.songArtists[songId] = artistId
+			elif field == "tracknumber":
+				try:
+					trackNumber = int(values[0])
+					if not 0 <= trackNumber < Song.invalidTrackNumber:
+						trackNumber = Song.invalidTrackNumber
+				except (IndexError, ValueError):
+					trackNumber = Song.invalidTrackNumber
+				cls.trackNumbers[songId] = trackNumber
+			else:
+				raise RuntimeError("Unsupported tag field \"%s\"" % field)
+	@classmethod
+	def setTagRows(cls, songIds, rows):
+		# like setTags() for many songs at once, with rows of (title, artist, track number) where
+		# missing titles and artists are None and the track number is already parsed like in setTagsLocked()
+		titles, artists, artistIds, songArtists, trackNumbers = cls.titles, cls.artists, cls.artistIds, cls.songArtists, cls.trackNumbers
+		with cls.lock:
+			for songId, (title, artist, trackNumber) in zip(songIds, rows):
+				titles[songId] = cls.MISSING if title is None else title
+				if artist is None:
+					songArtists[songId] = cls.MISSING
+				else:
+					artistId = artistIds.get(artist)
+					if artistId is None:
+						artistId = artistIds[artist] = len(artists)
+						artists.append(artist)
+					songArtists[songId] = artistId
+				trackNumbers[songId] = trackNumber
+
+	@classmethod
+	def path(cls, songId):
+		return cls.directories[cls.songDirectories[songId]] + cls.filenames[songId]
+	@classmethod
+	def normalizedPath(cls, songId):
+		directoryId = cls.songDirectories[songId]
+		directory = cls.normalizedDirectories.get(directoryId)
+		if directory is None:
+			directory = cls.normalizedDirectories[directoryId] = os.path.normcase(os.path.abspath(cls.directories[directoryId]))
+		return os.path.join(directory, os.path.normcase(cls.filenames[songId]))
+	@classmethod
+	def hasTag(cls, songId, field):
+		if field == "title":         return cls.titles.lengths[songId] != cls.NOT_READ
+		elif field == "artist":      return cls.songArtists[songId] != cls.NOT_READ
+		elif field == "tracknumber": return cls.trackNumbers[songId] != cls.TRACK_NUMBER_NOT_READ
+		else: raise RuntimeError("Unsupported tag field \"%s\"" % field)
+	@classmethod
+	def readTags(cls, songId, fields):
+		fields = [field for field in fields if not cls.hasTag(songId, field)]
+		if len(fields) > 0:
+			cls.setTags(songId, ID3Reader.read(cls.path(songId), fields))
+	@classmethod
+	def tags(cls, songId):
+		# the tags that were already read, like ID3Reader.read() returns them
+		tags = {}
+		if cls.hasTag(songId, "title"):
+			title = cls.titles[songId]
+			tags["title"] = [] if title == cls.MISSING else [title]
+		if cls.hasTag(songId, "artist"):
+			artistId = cls.songArtists[songId]
+			tags["artist"] = [] if artistId == cls.MISSING else [cls.artists[artistId]]
+		if cls.hasTag(songId, "tracknumber"):
+			trackNumber = cls.trackNumbers[songId]
+			tags["tracknumber"] = [] if trackNumber == Song.invalidTrackNumber else [str(trackNumber)]
+		return tags
+
+	@classmethod
+	def title(cls, songId):
+		if cls.titles.lengths[songId] == cls.NOT_READ:
+			cls.readTags(songId, ["title"])
+		title = cls.titles[songId]
+		return Song.invalidTitle if title == cls.MISSING else title
+	@classmethod
+	def artist(cls, songId):
+		if cls.songArtists[songId] == cls.NOT_READ:
+			cls.readTags(songId, ["artist"])
+		artistId = cls.songArtists[songId]
+		return Song.invalidArtist if artistId == cls.MISSING else cls.artists[artistId]
+	@classmethod
+	def trackNumber(cls, songId):
+		if cls.trackNumbers[songId] == cls.TRACK_NUMBER_NOT_READ:
+			cls.readTags(songId, ["tracknumber"])
+		return cls.trackNumbers[songId]
 
 class Song:
+	# a handle to a row of SongStore, created when the song is used and thrown away right after
+	__slots__ = ("id",)
 	invalidArtist = invalidTitle = chr(0x10ffff)
 	invalidTrackNumber = 0xffffffff
 
-	def __init__(self, path):
-		self.path = path
-		try: self.songID3 = EasyID3(path)
-		except: log(LogLevel.debug, "Unable to read ID3 tags for song at \"%s\"" % path)
+	def __init__(self, path, tags = None):
+		# tags maps the fields that were already read to their values, which are [] for missing fields
+		self.id = SongStore.add(path, tags)
+	@staticmethod
+	def fromId(songId):
+		song = object.__new__(Song)
+		song.id = songId
+		return song
 	def __repr__(self):
-		try:
-			artist = self.artist()
-			if artist is Song.invalidArtist:
-				return self.songID3["title"][0]
-			return "%s - %s" % (artist, self.songID3["title"][0])
-		except:
+		self.readTags(["title", "artist"])
+		title = self.title()
+		if title is Song.invalidTitle:
 			return self.path
+		artist = self.artist()
+		if artist is Song.invalidArtist:
+			return title
+		return "%s - %s" % (artist, title)
 	def __eq__(self, other):
-		return os.path.abspath(self.path) == os.path.abspath(other.path)
+		return self.id == other.id or self.normalizedPath() == other.normalizedPath()
 	def __ne__(self, other):
 		return not self == other
 
+	@property
+	def path(self):
+		return SongStore.path(self.id)
+	@property
+	def tags(self):
+		return SongStore.tags(self.id)
+	def normalizedPath(self):
+		return SongStore.normalizedPath(self.id)
+
+	def readTags(self, fields):
+		SongStore.readTags(self.id, fields)
+
 	def title(self):
-		try:
-			return self.songID3["title"][0]
-		except:
-			return Song.invalidTitle
+		return SongStore.title(self.id)
 	def artist(self):
-		try:
-			return self.songID3["artist"][0]
-		except:
-			return Song.invalidArtist
+		return SongStore.artist(self.id)
 	def trackNumber(self):
+		return SongStore.trackNumber(self.id)
+
+class SongList:
+	# the songs of a playlist as an array of song ids, turned into Song handles only when accessed
+	def __init__(self, songs = ()):
+		self.ids = songs.ids[:] if type(songs) is SongList else array("I", (song.id for song in songs))
+	@staticmethod
+	def fromIds(ids):
+		songs = SongList()
+		songs.ids = ids
+		return songs
+	@staticmethod
+	def fromPaths(paths):
+		return SongList.fromIds(SongStore.addPaths(paths))
+	def __len__(self):
+		return len(self.ids)
+	def __iter__(self):
+		return (Song.fromId(songId) for songId in self.ids)
+	def __getitem__(self, index):
+		if type(index) is slice:
+			return SongList.fromIds(self.ids[index])
+		return Song.fromId(self.ids[index])
+	def __setitem__(self, index, value):
+		if type(index) is slice:
+			self.ids[index] = SongList(value).ids
+		else:
+			self.ids[index] = value.id
+	def __delitem__(self, index):
+		del self.ids[index]
+
+	def append(self, song):
+		self.ids.append(song.id)
+	def insert(self, index, song):
+		self.ids.insert(index, song.id)
+	def index(self, song):
+		for i, songId in enumerate(self.ids):
+			if Song.fromId(songId) == song:
+				return i
+		raise ValueError("%r is not in the playlist" % song)
+
+class Scanner:
+	workers = 1
+	executor = None
+
+	@classmethod
+	def setup(cls, workers):
+		cls.workers = workers
+		if workers > 1:
+			from concurrent.futures import ThreadPoolExecutor
+			cls.executor = ThreadPoolExecutor(max_workers=workers)
+		log(LogLevel.debug, "Reading ID3 tags using %d workers" % workers)
+
+	@classmethod
+	def map(cls, function, iterable):
+		# results are always returned in the same order as the input, no matter which worker finishes first
+		if cls.executor is None:
+			return [function(item) for item in iterable]
+		return list(cls.executor.map(function, iterable))
+
+class TagIndex:
+	FIELDS = SongStore.FIELDS
+	rebuild = False
+	verify = False
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.entries = {}
+		self.changed = False
+		if TagIndex.rebuild:
+			self.changed = True
+			return
+
 		try:
-			return int(self.songID3["tracknumber"][0])
-		except:
-			return Song.invalidTrackNumber
+			with open(self.directory + TAG_INDEX_FILENAME) as indexFile:
+				self.entries = json.load(indexFile)
+		except FileNotFoundError: pass
+		except ValueError:
+			log(LogLevel.warning, "Invalid tag index at \"%s\": rebuilding it" % (self.directory + TAG_INDEX_FILENAME))
+			self.changed = True
+
+	def song(self, filename, fields):
+		path = self.directory + filename
+		stat = os.stat(path)
+		entry = self.entries.get(filename)
+		upToDate = entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns
+
+		tags = dict(entry[2]) if upToDate else {}
+		if upToDate and TagIndex.verify:
+			readTags = ID3Reader.read(path, list(tags) + [field for field in fields if field not in tags])
+			if any(readTags[field] != value for field, value in tags.items()):
+				log(LogLevel.warning, "Out of date tag index entry for song at \"%s\"" % path)
+			tags = readTags
+		else:
+			missingFields = [field for field in fields if field not in tags]
+			if len(missingFields) > 0:
+				tags.update(ID3Reader.read(path, missingFields))
+
+		if not upToDate or entry[2] != tags:
+			self.entries[filename] = [stat.st_size, stat.st_mtime_ns, tags]
+			self.changed = True
+		return Song(path, dict(tags))
+
+	def save(self, filenames):
+		for filename in list(self.entries):
+			if filename not in filenames:
+				del self.entries[filename]
+				self.changed = True
+		if not self.changed:
+			return
+
+		try:
+			writeFileAtomically(self.directory + TAG_INDEX_FILENAME, json.dumps(self.entries))
+			self.changed = False
+		except OSError:
+			log(LogLevel.warning, "Unable to save tag index at \"%s\"" % (self.directory + TAG_INDEX_FILENAME))
+
+class Catalog:
+	# the songs of every directory are stored together with the mtimes of the directories they were
+	# found in: as long as those mtimes do not change, the songs are loaded from here, already sorted
+	# by an index on the sort key of the play order, without listing directories or reading tags
+	SCHEMA = """
+		CREATE TABLE IF NOT EXISTS playlists (playlist TEXT PRIMARY KEY, recursive INTEGER);
+		CREATE TABLE IF NOT EXISTS directories (playlist TEXT, directory TEXT, mtime INTEGER, PRIMARY KEY (playlist, directory));
+		CREATE TABLE IF NOT EXISTS songs (
+			playlist TEXT, path TEXT, directory TEXT, absolutePath TEXT, size INTEGER, mtime INTEGER,
+			title TEXT, artist TEXT, tracknumber TEXT, titleKey TEXT, artistKey TEXT, trackNumberKey INTEGER,
+			PRIMARY KEY (playlist, path));
+		CREATE INDEX IF NOT EXISTS songsByTitle ON songs (playlist, titleKey, path);
+		CREATE INDEX IF NOT EXISTS songsByArtist ON songs (playlist, artistKey, path);
+		CREATE INDEX IF NOT EXISTS songsByTrackNumber ON songs (playlist, trackNumberKey, path);
+		CREATE INDEX IF NOT EXISTS songsByAbsolutePath ON songs (absolutePath);
+	"""
+	MAX_QUERY_PARAMETERS = 500
+
+	enabled = False
+	connection = None
+	lock = threading.Lock()
+
+	@classmethod
+	def setup(cls, filename):
+		import sqlite3
+		cls.connection = sqlite3.connect(filename, check_same_thread=False)
+		cls.connection.executescript(cls.SCHEMA)
+		cls.enabled = True
+		log(LogLevel.debug, "Using catalog at \"%s\"" % filename)
+
+	@staticmethod
+	def key(playlist):
+		return os.path.abspath(playlist.directory) + "/"
+	@staticmethod
+	def orderColumn(playOrder):
+		if   playOrder & Order.random:      return "path"
+		elif playOrder & Order.seededRandom: return "path"
+		elif playOrder & Order.path:        return "path"
+		elif playOrder & Order.title:       return "titleKey"
+		elif playOrder & Order.artist:      return "artistKey"
+		elif playOrder & Order.trackNumber: return "trackNumberKey"
+		else:                               return "path"
+	@staticmethod
+	def tags(title, artist, tracknumber):
+		return {
+			"title": [] if title is None else [title],
+			"artist": [] if artist is None else [artist],
+			"tracknumber": [] if tracknumber is None else [tracknumber],
+		}
+
+	@classmethod
+	def loadPlaylist(cls, playlist):
+		# returns the songs sorted by sortKey(), or None if the catalog is out of date
+		if TagIndex.rebuild or TagIndex.verify:
+			return None
+		key = cls.key(playlist)
+		with cls.lock:
+			row = cls.connection.execute("SELECT recursive FROM playlists WHERE playlist = ?", (key,)).fetchone()
+			if row is None or bool(row[0]) != Options.recursive:
+				return None
+
+			scannedDirectories, changedDirectories = {}, []
+			for relativeDirectory, mtime in cls.connection.execute("SELECT directory, mtime FROM directories WHERE playlist = ?", (key,)):
+				try:
+					if os.stat(playlist.directory + relativeDirectory).st_mtime_ns != mtime:
+						changedDirectories.append(relativeDirectory)
+				except FileNotFoundError:
+					return None
+				scannedDirectories[relativeDirectory] = (mtime, [], [])
+
+			rows = cls.sortedSongs(key, playlist.playOrder)
+
+		# files rewritten in place, e.g. retagged, do not change the mtime of their directory
+		directory, changed = playlist.directory, []
+		for relativeDirectory, path, size, mtime, title, artist, trackNumber in rows:
+			try:
+				stat = os.stat(directory + path)
+			except FileNotFoundError:
+				return None
+			if stat.st_size != size or stat.st_mtime_ns != mtime:
+				changed.append((path, stat))
+		if len(changed) > 0:
+			cls.updateSongs(playlist, changed)
+			with cls.lock:
+				rows = cls.sortedSongs(key, playlist.playOrder)
+
+		for relativeDirectory in scannedDirectories:
+			if relativeDirectory != "":
+				parent = relativeDirectory[:relativeDirectory.rstrip("/").rfind("/") + 1]
+				scannedDirectories[parent][2].append(relativeDirectory)
+		for relativeDirectory, path, _, _, _, _, _ in rows:
+			scannedDirectories[relativeDirectory][1].append(path)
+		playlist.scannedDirectories = scannedDirectories
+		if len(changedDirectories) > 0 and not cls.sameListings(playlist, changedDirectories):
+			return None
+
+		songIds = SongStore.addPaths([directory + path for _, path, _, _, _, _, _ in rows])
+		SongStore.setTagRows(songIds, [row[4:] for row in rows])
+		return SongList.fromIds(songIds)
+	@classmethod
+	def sameListings(cls, playlist, relativeDirectories):
+		# the player writes its own files (e.g. settings) in the directories, which changes their mtime:
+		# they are listed again and are still up to date if the same songs and subdirectories are found
+		for relativeDirectory in relativeDirectories:
+			_, oldFiles, oldSubdirectories = playlist.scannedDirectories[relativeDirectory]
+			try:
+				playlist.scanDirectory(relativeDirectory)
+			except OSError:
+				return False
+			_, files, subdirectories = playlist.scannedDirectories[relativeDirectory]
+			if set(files) != set(oldFiles) or set(subdirectories) != set(oldSubdirectories):
+				return False
+		key = cls.key(playlist)
+		with cls.lock, cls.connection:
+			cls.connection.executemany("UPDATE directories SET mtime = ? WHERE playlist = ? AND directory = ?",
+				[(playlist.scannedDirectories[relativeDirectory][0], key, relativeDirectory) for relativeDirectory in relativeDirectories])
+		return True
+	@classmethod
+	def sortedSongs(cls, key, playOrder):
+		return cls.connection.execute(
+			"SELECT directory, path, size, mtime, title, artist, trackNumberKey FROM songs WHERE playlist = ? ORDER BY %s, path" % cls.orderColumn(playOrder),
+			(key,)).fetchall()
+	@classmethod
+	def updateSongs(cls, playlist, changed):
+		# reads the tags of the changed songs again, together with their sort keys
+		key = cls.key(playlist)
+		songs = Scanner.map(lambda change: Song(playlist.directory + change[0], ID3Reader.read(playlist.directory + change[0], TagIndex.FIELDS)), changed)
+		songRows = [(stat.st_size, stat.st_mtime_ns,
+				(song.tags["title"] or [None])[0], (song.tags["artist"] or [None])[0], (song.tags["tracknumber"] or [None])[0],
+				song.title(), song.artist(), song.trackNumber(), key, path)
+			for (path, stat), song in zip(changed, songs)]
+		with cls.lock, cls.connection:
+			cls.connection.executemany("UPDATE songs SET size = ?, mtime = ?, title = ?, artist = ?, tracknumber = ?, "
+				"titleKey = ?, artistKey = ?, trackNumberKey = ? WHERE playlist = ? AND path = ?", songRows)
+		log(LogLevel.debug, "Updated %d changed songs of \"%s\" in the catalog" % (len(songRows), playlist.directory))
+
+	@classmethod
+	def storePlaylist(cls, playlist):
+		key = cls.key(playlist)
+		songs = {song.path: song for song in playlist.songs}
+		Scanner.map(lambda song: song.readTags(TagIndex.FIELDS), playlist.songs)
+
+		songRows, directoryRows = [], []
+		for relativeDirectory, (_, files, _) in playlist.scannedDirectories.items():
+			# the mtime is read again, since saving the tag index may have changed it
+			directoryRows.append((key, relativeDirectory, os.stat(playlist.directory + relativeDirectory).st_mtime_ns))
+			for file in files:
+				song = songs[playlist.directory + file]
+				stat = os.stat(song.path)
+				songRows.append((key, file, relativeDirectory, key + file, stat.st_size, stat.st_mtime_ns,
+					(song.tags["title"] or [None])[0], (song.tags["artist"] or [None])[0], (song.tags["tracknumber"] or [None])[0],
+					song.title(), song.artist(), song.trackNumber()))
+
+		with cls.lock, cls.connection:
+			cls.connection.execute("DELETE FROM songs WHERE playlist = ?", (key,))
+			cls.connection.execute("DELETE FROM directories WHERE playlist = ?", (key,))
+			cls.connection.executemany("INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", songRows)
+			cls.connection.executemany("INSERT INTO directories VALUES (?, ?, ?)", directoryRows)
+			cls.connection.execute("INSERT OR REPLACE INTO playlists VALUES (?, ?)", (key, int(Options.recursive)))
+		log(LogLevel.debug, "Stored %d songs of \"%s\" in the catalog" % (len(songRows), playlist.directory))
 
-def sortPlaylist(playlist):
+	@classmethod
+	def invalidate(cls, playlist):
+		with cls.lock, cls.connection:
+			cls.connection.execute("DELETE FROM playlists WHERE playlist = ?", (cls.key(playlist),))
+
+	@classmethod
+	def songs(cls, absolutePaths):
+		# returns the songs at the provided absolute paths whose size and mtime did not change
+		songs = {}
+		absolutePaths = list(absolutePaths)
+		for start in range(0, len(absolutePaths), cls.MAX_QUERY_PARAMETERS):
+			chunk = absolutePaths[start:start + cls.MAX_QUERY_PARAMETERS]
+			with cls.lock:
+				rows = cls.connection.execute(
+					"SELECT absolutePath, size, mtime, title, artist, tracknumber FROM songs WHERE absolutePath IN (%s)" % ",".join("?" * len(chunk)),
+					chunk).fetchall()
+			for absolutePath, size, mtime, title, artist, tracknumber in rows:
+				try:
+					stat = os.stat(absolutePath)
+				except FileNotFoundError:
+					continue
+				if stat.st_size == size and stat.st_mtime_ns == mtime:
+					songs[absolutePath] = Song(absolutePath, cls.tags(title, artist, tracknumber))
+		return songs
+
+class RemainingIndices:
+	# the indices in range(size) that were not popped yet, stored in a Fenwick tree that counts
+	# them, so that popping the k-th remaining one takes O(log size) instead of O(size) like list.pop
+	def __init__(self, size):
+		self.size = size
+		self.remaining = size
+		self.tree = [0] * (size + 1)
+		for i in range(1, size + 1):
+			self.tree[i] += 1
+			parent = i + (i & -i)
+			if parent <= size:
+				self.tree[parent] += self.tree[i]
+	def __len__(self):
+		return self.remaining
+
+	def pop(self, k):
+		if k < 0 or k >= self.remaining:
+			raise IndexError("pop index %d out of range" % k)
+
+		# binary search on the tree for the last position with at most k remaining indices before it
+		position = 0
+		step = 1 << self.size.bit_length()
+		while step > 0:
+			if position + step <= self.size and self.tree[position + step] <= k:
+				position += step
+				k -= self.tree[position]
+			step >>= 1
+
+		i = position + 1
+		while i <= self.size:
+			self.tree[i] -= 1
+			i += i & -i
+		self.remaining -= 1
+		return position
+
+class SeededPermutation:
+	# a pseudorandom bijection of range(size) determined by the seed: a Feistel network over the
+	# smallest power of 4 not smaller than size, walking the cycle until the result is in range.
+	# Every value (and its inverse) is computed in O(1) on its own, without shuffling a list
+	ROUNDS = 4
+	MASK = 0xffffffffffffffff
+
+	def __init__(self, size, seed):
+		self.size = size
+		self.halfBits = max(1, ((size - 1).bit_length() + 1) // 2)
+		self.halfMask = (1 << self.halfBits) - 1
+		self.keys = [self.mix(seed + i) for i in range(self.ROUNDS)]
+	def __len__(self):
+		return self.size
+
+	@classmethod
+	def mix(cls, value):
+		# splitmix64 finalizer
+		value = (value + 0x9e3779b97f4a7c15) & cls.MASK
+		value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & cls.MASK
+		value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & cls.MASK
+		return value ^ (value >> 31)
+	def round(self, half, key):
+		return self.mix(half ^ key) & self.halfMask
+
+	def __getitem__(self, index):
+		if index < 0 or index >= self.size:
+			raise IndexError("permutation index %d out of range" % index)
+		while 1:
+			left, right = index >> self.halfBits, index & self.halfMask
+			for key in self.keys:
+				left, right = right, left ^ self.round(right, key)
+			index = (left << self.halfBits) | right
+			if index < self.size:
+				return index
+	def inverse(self, value):
+		if value < 0 or value >= self.size:
+			raise IndexError("permutation value %d out of range" % value)
+		while 1:
+			left, right = value >> self.halfBits, value & self.halfMask
+			for key in reversed(self.keys):
+				left, right = right ^ self.round(left, key), left
+			value = (left << self.halfBits) | right
+			if value < self.size:
+				return value
+
+def sortKey(playOrder):
+	# the key is computed from the song id, see SongStore
+	if   playOrder & Order.random:       return None
+	elif playOrder & Order.weighted:     return None
+	elif playOrder & Order.seededRandom: return SongStore.path
+	elif playOrder & Order.path:        return SongStore.path
+	elif playOrder & Order.title:       return SongStore.title
+	elif playOrder & Order.artist:      return SongStore.artist
+	elif playOrder & Order.trackNumber: return SongStore.trackNumber
+	else:                               return None
+
+def sortPlaylist(playlist, presorted = False):
+	# presorted means that the songs are already sorted by sortKey(), e.g. by the catalog.
+	# Only the array of song ids is sorted, without creating Song objects
+	songIds = playlist.songs.ids
 	if playlist.playOrder & Order.random:
-		random.shuffle(playlist.songs)
+		random.shuffle(songIds)
+	elif playlist.playOrder & Order.weighted:
+		# a weighted shuffle: the key of every song is exponentially distributed with its weight as
+		# the rate, so the first song is picked with probability proportional to its weight, and so
+		# on for the following ones among the remaining songs
+		now = time()
+		songIds = array("I", sorted(songIds, key=lambda songId: random.expovariate(History.weight(songId, now))))
 	else:
-		if   playlist.playOrder & Order.path:        playlist.songs = sorted(playlist.songs, key = lambda song: song.path)
-		elif playlist.playOrder & Order.title:       playlist.songs = sorted(playlist.songs, key = lambda song: song.title())
-		elif playlist.playOrder & Order.artist:      playlist.songs = sorted(playlist.songs, key = lambda song: song.artist())
-		elif playlist.playOrder & Order.trackNumber: playlist.songs = sorted(playlist.songs, key = lambda song: song.trackNumber())
-
-		if playlist.playOrder & Order.modified:
-			if len(playlist.songs) < 5:
-				random.shuffle(playlist.songs)
-			for i in range(0, len(playlist.songs) - 5, 4):
-				playlist.songs[i:i+5] = sorted(playlist.songs[i:i+5], key=lambda s: random.random())
+		key = sortKey(playlist.playOrder)
+		if key is not None and not presorted:
+			songIds = array("I", sorted(songIds, key = key))
+
+		if playlist.playOrder & Order.seededRandom:
+			# songs are shuffled while playing, see Playlist.songAt()
+			pass
+		elif playlist.playOrder & Order.modified:
+			if len(songIds) < 5:
+				random.shuffle(songIds)
+			for i in range(0, len(songIds) - 5, 4):
+				songIds[i:i+5] = array("I", sorted(songIds[i:i+5], key=lambda s: random.random()))
 		elif playlist.playOrder & Order.distributed:
-			indices = list(range(len(playlist.songs)))
-			copiedPlaylist = []
+			indices = RemainingIndices(len(songIds))
+			copiedPlaylist = array("I")
 			# sample from a random variable distributed as Uniform[1, ...]**(1/exponent):
 			# videos early in the list have higher probability, but not by too much
 			while len(indices) > 0:
@@ -381,21 +1741,300 @@ def sortPlaylist(playlist):
 				random_var_squared = random.uniform(1, (len(indices) + 0.99) ** exponent)
 				random_var = int(random_var_squared ** (1/exponent) - 1)
 				i = indices.pop(random_var)
-				copiedPlaylist.append(playlist.songs[i])
-			playlist.songs[:] = copiedPlaylist[:]
+				copiedPlaylist.append(songIds[i])
+			songIds = copiedPlaylist
+	playlist.songs.ids = songIds
+
+def insertSong(playlist, song):
+	# keeps the current play order without sorting or shuffling all songs again
+	key = sortKey(playlist.playOrder)
+	if playlist.playOrder & Order.listed:
+		# new songs are listed after the others
+		index = len(playlist.songs)
+	elif key is None or playlist.playOrder & Order.distributed:
+		index = random.randint(0, len(playlist.songs))
+	else:
+		songKey, songIds = key(song.id), playlist.songs.ids
+		low, high = 0, len(songIds)
+		while low < high:
+			middle = (low + high) // 2
+			if key(songIds[middle]) <= songKey:
+				low = middle + 1
+			else:
+				high = middle
+		index = low
+
+	playlist.songs.insert(index, song)
+	if index <= playlist.currentSong:
+		playlist.currentSong += 1
+
+def playlistFileLines(songs, positions):
+	# the lines of an M3U8 file with the songs at the provided positions; titles are included
+	# only for the songs whose tags were already read
+	yield "#EXTM3U\n"
+	for position in positions:
+		song = songs[position]
+		title, artist = song.tags.get("title"), song.tags.get("artist")
+		if title:
+			yield "#EXTINF:-1,%s%s\n" % (artist[0] + " - " if artist else "", title[0])
+		yield os.path.abspath(song.path) + "\n"
+
+class Duplicates:
+	# finds songs whose audio is the same even if they are different files, comparing the hashes of
+	# their audio data without the ID3 tags. Hashes are computed by a pool of processes reading the
+	# files through mmap, and cached in HASHES_FILENAME by path, together with size and mtime
+	mode = None
+	lock = threading.Lock()
+	# maps normalized paths to [size, mtime, hash]
+	cache = {}
+	changed = False
+	# maps the hashes of the songs played in this session to the normalized path they were played from
+	played = {}
+
+	@classmethod
+	def setup(cls, mode):
+		cls.mode = mode
+		if mode is None:
+			return
+		try:
+			with open(HASHES_FILENAME) as hashesFile:
+				cls.cache = json.load(hashesFile)
+		except FileNotFoundError: pass
+		except ValueError:
+			log(LogLevel.warning, "Ignoring invalid song hashes in \"%s\"" % HASHES_FILENAME)
+
+	@staticmethod
+	def hashFile(path):
+		# returns None if the file can not be read
+		import hashlib, mmap
+		try:
+			with open(path, "rb") as songFile:
+				digest = hashlib.blake2b(digest_size=16)
+				size = os.fstat(songFile.fileno()).st_size
+				if size == 0:
+					return digest.hexdigest()
+				with mmap.mmap(songFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+					start, end = 0, size
+					# ID3v2 tags (possibly more than one) at the beginning, with an optional footer
+					while end - start >= 10 and data[start:start+3] == b"ID3":
+						start += 10 + ID3Reader.syncsafe(data[start+6:start+10]) + (10 if data[start+5] & 0x10 else 0)
+					# ID3v1 tag at the end, possibly preceded by an enhanced tag
+					if end - start >= 128 and data[end-128:end-125] == b"TAG":
+						end -= 128
+						if end - start >= 227 and data[end-227:end-223] == b"TAG+":
+							end -= 227
+					with memoryview(data) as view, view[min(start, end):end] as audio:
+						digest.update(audio)
+				return digest.hexdigest()
+		except (OSError, ValueError):
+			return None
+	@staticmethod
+	def importable():
+		# whether other processes can import this module to run hashFile()
+		import importlib.util
+		try:
+			return __name__ == "__main__" or importlib.util.find_spec(__name__) is not None
+		except ValueError:
+			return False
+	@classmethod
+	def compute(cls, paths):
+		with Profiler.measure("hashSongs"):
+			if len(paths) >= DUPLICATES_MIN_PROCESS_HASHES and cls.importable():
+				try:
+					import multiprocessing
+					from concurrent.futures import ProcessPoolExecutor
+					# spawned instead of forked, since other threads may be holding locks
+					with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as executor:
+						return list(executor.map(Duplicates.hashFile, paths, chunksize=32))
+				except Exception as e:
+					log(LogLevel.debug, "Unable to hash songs in other processes, using threads: %s" % e)
+			# hashlib releases the GIL while hashing, so threads help too
+			return Scanner.map(Duplicates.hashFile, paths)
 
+	@classmethod
+	def hashes(cls, songs):
+		# the hashes of the songs (None for unreadable ones), computing only the out of date ones
+		paths = [song.normalizedPath() for song in songs]
+		result, missing = [None] * len(paths), []
+		for i, path in enumerate(paths):
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			entry = cls.cache.get(path)
+			if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+				result[i] = entry[2]
+			else:
+				missing.append((i, path, stat))
+		if len(missing) == 0:
+			return result
+
+		log(LogLevel.debug, "Hashing %d songs to find duplicates" % len(missing))
+		digests = cls.compute([path for _, path, _ in missing])
+		with cls.lock:
+			for (i, path, stat), digest in zip(missing, digests):
+				if digest is not None:
+					cls.cache[path] = [stat.st_size, stat.st_mtime_ns, digest]
+					result[i] = digest
+			cls.changed = True
+		cls.save()
+		return result
+	@classmethod
+	def known(cls, song):
+		# the cached hash of the song, without reading it
+		entry = cls.cache.get(song.normalizedPath())
+		return None if entry is None else entry[2]
+	@classmethod
+	def save(cls):
+		with cls.lock:
+			if not cls.changed:
+				return
+			try:
+				writeFileAtomically(HASHES_FILENAME, json.dumps(cls.cache))
+				cls.changed = False
+			except OSError:
+				log(LogLevel.warning, "Unable to save song hashes to \"%s\"" % HASHES_FILENAME)
+
+	@classmethod
+	def collapse(cls, songs, hashes = ()):
+		# keeps only the song with the lowest path among the ones with the same hash, dropping also
+		# the songs whose hash is in hashes
+		hashes, kept = set(hashes), {}
+		songHashes = cls.hashes(songs)
+		for i, (song, digest) in enumerate(zip(songs, songHashes)):
+			if digest is not None and digest not in hashes and (digest not in kept or song.path < songs[kept[digest]].path):
+				kept[digest] = i
+		collapsed = SongList()
+		for i, (song, digest) in enumerate(zip(songs, songHashes)):
+			if digest is None or kept.get(digest) == i:
+				collapsed.append(song)
+		if len(collapsed) < len(songs):
+			log(LogLevel.debug, "Collapsed %d duplicate songs" % (len(songs) - len(collapsed)))
+		return collapsed
+	@classmethod
+	def playedElsewhere(cls, song):
+		# whether the same audio was already played from another file, marking the song as played
+		digest = cls.known(song)
+		if digest is None:
+			return False
+		path = song.normalizedPath()
+		return cls.played.setdefault(digest, path) != path
+
+class History:
+	# plays, skips and favourite toggles are appended to a journal as they happen, which is compacted
+	# every once in a while into the counters of every song, saved in HISTORY_FILENAME as
+	# {normalized path: [plays, skips, time last played or skipped, whether it is a favourite]}
+	counters = {}
+	journalLength = 0
+	lock = threading.Lock()
+
+	@classmethod
+	def setup(cls):
+		try:
+			with open(HISTORY_FILENAME) as historyFile:
+				cls.counters = json.load(historyFile)
+		except FileNotFoundError: pass
+		except ValueError:
+			log(LogLevel.warning, "Ignoring invalid play history in \"%s\"" % HISTORY_FILENAME)
+		cls.journalLength = 0
+		try:
+			with open(HISTORY_JOURNAL_FILENAME, errors="surrogateescape") as journalFile:
+				for line in journalFile:
+					try:
+						operation, timestamp, path = line.rstrip("\n").split(" ", 2)
+						cls.apply(operation, int(timestamp), path)
+					except ValueError:
+						# the last line may have been written only partially
+						continue
+					cls.journalLength += 1
+		except FileNotFoundError: pass
+		if cls.journalLength > HISTORY_JOURNAL_MAX_LENGTH:
+			cls.writeSettings()
+
+	@classmethod
+	def apply(cls, operation, timestamp, path):
+		counters = cls.counters.setdefault(os.path.normcase(path), [0, 0, 0, 0])
+		if operation == "p":
+			counters[0] += 1
+			counters[2] = max(counters[2], timestamp)
+		elif operation == "s":
+			counters[1] += 1
+			counters[2] = max(counters[2], timestamp)
+		elif operation == "+":
+			counters[3] = 1
+		elif operation == "-":
+			counters[3] = 0
+	@classmethod
+	def record(cls, operation, song):
+		# operation is "p" (played until the end), "s" (skipped), "+" or "-" (favourite toggled)
+		path, timestamp = os.path.abspath(song.path), int(time())
+		with cls.lock:
+			cls.apply(operation, timestamp, path)
+			cls.journalLength += 1
+			try:
+				with open(HISTORY_JOURNAL_FILENAME, "a", errors="surrogateescape") as journalFile:
+					journalFile.write("%s %d %s\n" % (operation, timestamp, path))
+			except OSError as e:
+				log(LogLevel.warning, "Unable to save play history: %s" % e)
+		if cls.journalLength > HISTORY_JOURNAL_MAX_LENGTH:
+			# compacted by the checkpoint thread, see Settings
+			Settings.markDirty(History)
+	@classmethod
+	def writeSettings(cls):
+		with cls.lock:
+			if cls.journalLength == 0:
+				return
+			writeFileAtomically(HISTORY_FILENAME, json.dumps(cls.counters))
+			# the journal is now included in the counters
+			try: os.remove(HISTORY_JOURNAL_FILENAME)
+			except FileNotFoundError: pass
+			cls.journalLength = 0
+
+	@classmethod
+	def weight(cls, songId, now):
+		# songs played or skipped recently are less likely, and so are songs that are often skipped
+		path = SongStore.normalizedPath(songId)
+		plays, skips, lastPlayed, favourite = cls.counters.get(path, (0, 0, 0, 0))
+		recency = max(HISTORY_MIN_RECENCY_WEIGHT, 1 - math.exp(min(0, lastPlayed - now) / HISTORY_RECENCY))
+		weight = recency * (plays + 1) / (plays + skips + 2)
+		if favourite or path in Favourites.paths:
+			weight *= HISTORY_FAVOURITE_WEIGHT
+		return weight
 
 class Favourites:
+	songs = SongList()
+	# normalized paths of all songs, to check whether a song is a favourite in constant time
+	paths = set()
+	# hashes of the audio of all songs, see Duplicates
+	hashes = set()
+	# the songs left out by Duplicates.collapse(), which are not played but stay in the favourites file
+	duplicates = SongList()
+	journalLength = 0
+	playing = False
+	# the songs are changed while playing and written by the checkpoint thread
+	lock = threading.RLock()
+
 	@classmethod
 	def setup(cls, playOrder, startSong):
 		songFilenames, filePlayOrder, fileStartSong = cls.loadFromFile()
 
-		cls.songs = []
+		existingFilenames = []
 		for songFilename in songFilenames:
 			if os.path.exists(songFilename):
-				cls.songs.append(Song(songFilename))
+				existingFilenames.append(songFilename)
 			else:
 				log(LogLevel.debug, "Discarding favourite song at \"%s\": no such file" % songFilename)
+		catalogSongs = Catalog.songs(existingFilenames) if Catalog.enabled else {}
+		cls.songs = SongList(catalogSongs.get(songFilename) or Song(songFilename) for songFilename in existingFilenames)
+		if Duplicates.mode == "collapse":
+			allSongs = cls.songs
+			cls.songs = Duplicates.collapse(allSongs)
+			keptIds = set(cls.songs.ids)
+			cls.duplicates = SongList.fromIds(array("I", (songId for songId in allSongs.ids if songId not in keptIds)))
+		cls.paths = set(song.normalizedPath() for song in cls.songs) | set(song.normalizedPath() for song in cls.duplicates)
+		if Duplicates.mode is not None:
+			cls.hashes = set(Duplicates.hashes(cls.songs))
+			cls.hashes.discard(None)
 		if len(cls.songs) == 0:
 			log(LogLevel.warning, "Favourites playlist is empty")
 
@@ -408,6 +2047,9 @@ class Favourites:
 			cls.playOrder = Order.cast(playOrder)
 			if playOrder is not None and cls.playOrder is None:
 				raise RuntimeError("Invalid play order \"%s\" for favourites of type \"%s\"" % (playOrder, type(playOrder)))
+		if cls.playOrder & Order.seededRandom:
+			log(LogLevel.warning, "Seeded random order is not supported for favourites: using random order")
+			cls.playOrder = Order.random
 
 		if startSong is None:
 			if fileStartSong is None:
@@ -417,7 +2059,15 @@ class Favourites:
 		else:
 			cls.currentSong = startSong
 
-		sortPlaylist(Favourites)
+		fields = Order.tagFields(cls.playOrder)
+		Scanner.map(lambda song: song.readTags(fields), cls.songs)
+		with Profiler.measure("sortPlaylist favourites"):
+			sortPlaylist(Favourites)
+		if cls.journalLength > FAVOURITES_JOURNAL_MAX_LENGTH:
+			cls.compact()
+		if playOrder is not None or startSong is not None:
+			# manually provided settings overwrite the saved ones
+			Settings.markDirty(Favourites)
 		# this is done since __next__ does += 1 even the first time
 		cls.currentSong -= 1
 
@@ -426,9 +2076,21 @@ class Favourites:
 	def __next__(self):
 		Favourites.currentSong += 1
 		Favourites.currentSong %= len(Favourites.songs)
+		Settings.markDirty(Favourites)
 		return Favourites.songs[Favourites.currentSong]
 	def __len__(self):
 		return len(Favourites.songs)
+	def peek(self):
+		if len(Favourites.songs) == 0:
+			return None
+		return Favourites.songs[(Favourites.currentSong + 1) % len(Favourites.songs)]
+	def upcoming(self, count):
+		songs = Favourites.songs
+		return [songs[(Favourites.currentSong + i) % len(songs)] for i in range(1, min(count, len(songs) - 1) + 1)]
+	def load(self):
+		pass
+	def isLoaded(self):
+		return True
 	@property
 	def currentSong(self):
 		return Favourites.currentSong
@@ -436,12 +2098,24 @@ class Favourites:
 	@classmethod
 	def move(cls, delta):
 		cls.currentSong += delta
+		Settings.markDirty(Favourites)
 	@classmethod
 	def setPos(cls, value):
 		cls.currentSong = value
+		Settings.markDirty(Favourites)
 	@classmethod
 	def pos(cls):
 		return cls.currentSong
+	@classmethod
+	def setPlaying(cls, playing):
+		cls.playing = playing
+		Settings.markDirty(Favourites)
+	@classmethod
+	def resumePosition(cls):
+		if len(cls.songs) == 0:
+			return 0
+		# when not playing, __next__ has still to be called for the song to resume from
+		return (cls.currentSong if cls.playing else cls.currentSong + 1) % len(cls.songs)
 
 	@classmethod
 	def loadFromFile(cls):
@@ -455,41 +2129,144 @@ class Favourites:
 				except ValueError: startSong = None
 
 				songFilenames = [line.strip() for line in favouritesFile]
-
-				return (songFilenames, playOrder, startSong)
 		except FileNotFoundError:
-			return ([], None, None)
+			playOrder, startSong, songFilenames = None, None, []
+
+		try:
+			# written by writeSettings() instead of the whole favourites file, so it is more recent
+			with open(FAVOURITES_POSITION_FILENAME) as positionFile:
+				playOrder = Order.cast(positionFile.readline().strip()) or playOrder
+				try: startSong = int(positionFile.readline().strip())
+				except ValueError: pass
+		except FileNotFoundError: pass
+
+		return (cls.applyJournal(songFilenames), playOrder, startSong)
+	@classmethod
+	def applyJournal(cls, songFilenames):
+		# maps normalized paths to paths, keeping the order of the favourites file
+		songFilenames = {os.path.normcase(songFilename): songFilename for songFilename in songFilenames if songFilename != ""}
+		cls.journalLength = 0
+		try:
+			with open(FAVOURITES_JOURNAL_FILENAME) as journalFile:
+				for line in journalFile:
+					operation, songFilename = line[:1], line[2:].rstrip("\n")
+					if operation == "+":
+						songFilenames[os.path.normcase(songFilename)] = songFilename
+					elif operation == "-":
+						songFilenames.pop(os.path.normcase(songFilename), None)
+					cls.journalLength += 1
+		except FileNotFoundError: pass
+		return list(songFilenames.values())
+	@classmethod
+	def appendToJournal(cls, operation, song):
+		cls.journalLength += 1
+		if cls.journalLength > FAVOURITES_JOURNAL_MAX_LENGTH:
+			cls.compact()
+		else:
+			with open(FAVOURITES_JOURNAL_FILENAME, "a") as journalFile:
+				journalFile.write("%s %s\n" % (operation, os.path.abspath(song.path)))
+	@classmethod
+	def settings(cls):
+		currentSong = 0 if cls.playOrder in [Order.random, Order.weighted] else cls.resumePosition()
+		return "%s\n%s\n" % (Order.toCode(cls.playOrder), currentSong)
 	@classmethod
 	def writeSettings(cls):
-		with open(FAVOURITES_FILENAME, "w") as favouritesFile:
-			if cls.playOrder == Order.random:
-				favouritesFile.write("%s\n%s\n" % (cls.playOrder.value, 0))
-			else:
-				favouritesFile.write("%s\n%s\n" % (cls.playOrder.value, cls.currentSong))
-			favouritesFile.write("\n".join([os.path.abspath(song.path) for song in cls.songs]))
+		# only the play order and the position, since added and removed songs are in the journal
+		with cls.lock:
+			writeFileAtomically(FAVOURITES_POSITION_FILENAME, cls.settings())
+	@classmethod
+	def compact(cls):
+		# merges the journal and the position into the favourites file
+		with cls.lock:
+			writeFileAtomically(FAVOURITES_FILENAME, cls.settings()
+				+ "\n".join([os.path.abspath(song.path) for songs in [cls.songs, cls.duplicates] for song in songs]))
+			for filename in [FAVOURITES_JOURNAL_FILENAME, FAVOURITES_POSITION_FILENAME]:
+				try: os.remove(filename)
+				except FileNotFoundError: pass
+			cls.journalLength = 0
 
 	@classmethod
 	def add(cls, song):
-		cls.songs.append(song)
-		cls.writeSettings()
-		sortPlaylist(cls)
+		with cls.lock:
+			if cls.isFavourite(song):
+				return
+			if Duplicates.mode is not None:
+				# the same audio may be a favourite in another file even if this song was not hashed yet
+				digest = Duplicates.hashes([song])[0]
+				if digest in cls.hashes:
+					return
+				if digest is not None:
+					cls.hashes.add(digest)
+			insertSong(cls, song)
+			cls.paths.add(song.normalizedPath())
+			cls.appendToJournal("+", song)
 	@classmethod
 	def remove(cls, song):
-		cls.songs = [oldSong for oldSong in cls.songs if oldSong != song]
-		cls.writeSettings()
+		with cls.lock:
+			if not cls.isFavourite(song):
+				return
+			# all the files with the same audio are removed
+			path = song.normalizedPath()
+			digest = Duplicates.known(song) if Duplicates.mode is not None else None
+			for index in reversed(range(len(cls.songs))):
+				oldSong = cls.songs[index]
+				oldPath = oldSong.normalizedPath()
+				if oldPath == path or (digest is not None and Duplicates.known(oldSong) == digest):
+					del cls.songs[index]
+					if index < cls.currentSong:
+						cls.currentSong -= 1
+					cls.paths.discard(oldPath)
+					cls.appendToJournal("-", oldSong)
+			for index in reversed(range(len(cls.duplicates))):
+				oldSong = cls.duplicates[index]
+				if digest is not None and Duplicates.known(oldSong) == digest:
+					del cls.duplicates[index]
+					cls.paths.discard(oldSong.normalizedPath())
+					cls.appendToJournal("-", oldSong)
+			cls.hashes.discard(digest)
 
 	@classmethod
 	def isFavourite(cls, song):
-		return song in cls.songs
+		return song.normalizedPath() in cls.paths or (Duplicates.mode is not None and Duplicates.known(song) in cls.hashes)
+
+	@classmethod
+	def positionOf(cls, song):
+		return next((i for i, other in enumerate(cls.songs) if other.path == song.path), None)
+	@classmethod
+	def export(cls, filename):
+		with cls.lock:
+			songs = list(cls.songs)
+			start = cls.resumePosition()
+		writeFileAtomically(filename, playlistFileLines(songs, ((start + i) % len(songs) for i in range(len(songs)))))
 
 class Playlist:
+	defaultPlayOrder = Order.default
+
 	class EmptyDirectory(BaseException):
-		def __init__(self, directory):
+		# also raised when the directory (or playlist file) can not be read, so that it is skipped too
+		def __init__(self, directory, reason = None):
 			self.directory = directory
+			self.reason = reason
 		def what(self):
+			if self.reason is not None:
+				return "Unable to read provided directory %s: %s" % (self.directory, self.reason)
 			return "Provided directory %s is empty" % self.directory
 
 	def __init__(self, directoryOrFilenames, playOrder = None, startSong = None):
+		self.loadLock = threading.Lock()
+		self.presorted = False
+		# whether the songs were loaded in the order saved by writeOrder(), so they must not be sorted
+		self.materialized = False
+		# maps every scanned directory, relative to self.directory, to (mtime, mp3 files, subdirectories)
+		self.scannedDirectories = {}
+		self.lastRefresh = monotonic()
+		# with the seeded random order songs stay sorted by path and are played in permutation order
+		self.seed = None
+		self.permutation = None
+		# whether the order of the songs changed since it was last written by writeOrder()
+		self.orderChanged = True
+		self.playing = False
+
 		if type(directoryOrFilenames) is str:
 			if len(directoryOrFilenames) > 0 and directoryOrFilenames[-1] != "/":
 				directoryOrFilenames += "/"
@@ -508,7 +2285,7 @@ class Playlist:
 
 			if self.playOrder is None or self.currentSong is None:
 				try:
-					with open(self.directory + SETTINGS_FILENAME) as settingsFile:
+					with open(self.settingsFilename()) as settingsFile:
 						filePlayOrder = settingsFile.readline().strip()
 						fileStartSong = settingsFile.readline().strip()
 
@@ -520,13 +2297,23 @@ class Playlist:
 				except FileNotFoundError: pass
 
 				if self.playOrder is None:
-					self.playOrder = Order.default
-				if self.currentSong is None or self.playOrder is Order.random:
+					self.playOrder = self.defaultPlayOrder
+				if self.currentSong is None or (self.playOrder in [Order.random, Order.weighted] and not Options.keepOrder):
 					self.currentSong = 0
 
-			self.name = self.directory.split("/")[-1]
+			if self.playOrder & Order.seededRandom:
+				self.seed = self.loadSeed()
+				if self.seed is None:
+					self.seed = random.getrandbits(64)
+					Settings.markDirty(self)
+
+			if playOrder is not None or startSong is not None:
+				# manually provided settings overwrite the saved ones
+				Settings.markDirty(self)
 
-			self.loadSongs()
+			self.name = self.directory.split("/")[-1]
+			# songs are loaded only when the playlist is first played, see load()
+			self.songs = None
 		elif type(directoryOrFilenames) is list:
 			self.playOrder = Order.cast(playOrder)
 			if playOrder is not None and self.playOrder is None:
@@ -534,45 +2321,591 @@ class Playlist:
 
 			self.currentSong = startSong
 
-			self.songs = []
-			for filename in directoryOrFilenames:
-				self.songs.append(Song(filename))
+			self.songs = SongList.fromPaths(directoryOrFilenames)
+			self.sort()
 		else:
 			raise TypeError()
-
-		sortPlaylist(self)
-		# this is done since __next__ does += 1 even the first time
-		self.currentSong -= 1
 	def __iter__(self):
 		return self
 	def __next__(self):
+		self.load()
+		self.refresh()
 		self.currentSong += 1
 		self.currentSong %= len(self.songs)
-		return self.songs[self.currentSong]
+		Settings.markDirty(self)
+		return self.songAt(self.currentSong)
 	def __len__(self):
+		self.load()
 		return len(self.songs)
+	def peek(self):
+		self.load()
+		return self.songAt((self.currentSong + 1) % len(self.songs))
+	def upcoming(self, count):
+		# the songs that are played after the current one, without moving
+		self.load()
+		return [self.songAt((self.currentSong + i) % len(self.songs)) for i in range(1, min(count, len(self.songs) - 1) + 1)]
+	def songAt(self, position):
+		if self.permutation is None:
+			return self.songs[position]
+		return self.songs[self.permutation[position]]
 
 	def move(self, delta):
 		self.currentSong += delta
+		Settings.markDirty(self)
 	def setPos(self, value):
 		self.currentSong = value
+		Settings.markDirty(self)
 	def pos(self):
 		return self.currentSong
+	def setPlaying(self, playing):
+		self.playing = playing
+		Settings.markDirty(self)
+	def resumePosition(self):
+		# the start song has not been adjusted by load() yet, see sort()
+		if not self.isLoaded():
+			return self.currentSong
+		# when not playing, __next__ has still to be called for the song to resume from
+		return (self.currentSong if self.playing else self.currentSong + 1) % len(self.songs)
+
+	def isLoaded(self):
+		return self.songs is not None
+	def load(self):
+		with self.loadLock:
+			if self.isLoaded():
+				return
+			try:
+				self.loadSongs()
+			except OSError as e:
+				# e.g. a mistyped or removed directory, which is reached only when it is first played
+				raise Playlist.EmptyDirectory(self.location(), e.strerror or e)
+			if Duplicates.mode == "collapse":
+				self.songs = Duplicates.collapse(self.songs)
+			self.sort()
+			self.orderChanged = not self.materialized
+			if self.seed is not None:
+				self.permutation = SeededPermutation(len(self.songs), self.seed)
+	def sort(self):
+		if not self.materialized:
+			with Profiler.measure("sortPlaylist %s" % getattr(self, "directory", "")):
+				sortPlaylist(self, self.presorted)
+		# this is done since __next__ does += 1 even the first time
+		self.currentSong -= 1
 
 	def loadSongs(self):
-		self.songs = []
-		files = os.listdir(self.directory)
-		for file in files:
-			if file[-4:] == ".mp3":
-				self.songs.append(Song(self.directory + file))
-		if len(self.songs) == 0:
+		if Catalog.enabled:
+			songs = Catalog.loadPlaylist(self)
+			if songs is not None and len(songs) > 0:
+				log(LogLevel.debug, "Loaded %d songs of \"%s\" from the catalog" % (len(songs), self.directory))
+				self.songs = songs
+				self.presorted = True
+				self.lastRefresh = monotonic()
+				if Options.keepOrder:
+					orderedFiles = self.loadOrder([song.path[len(self.directory):] for song in songs])
+					if orderedFiles is not None:
+						songsByPath = {song.path: song for song in songs}
+						self.songs = SongList(songsByPath[self.directory + file] for file in orderedFiles)
+						self.materialized = True
+				return
+
+		self.scannedDirectories = {}
+		with Profiler.measure("listDirectory %s" % self.directory):
+			files = self.scanTree("")
+		if Options.keepOrder and len(files) > 0:
+			orderedFiles = self.loadOrder(files)
+			if orderedFiles is not None:
+				# tags are not needed, since the songs are not going to be sorted
+				self.songs = SongList.fromPaths(self.directory + file for file in orderedFiles)
+				self.materialized = True
+				self.lastRefresh = monotonic()
+				return
+
+		log(LogLevel.debug, "Scanning %d songs in \"%s\"" % (len(files), self.directory))
+		songs = self.createSongs(files)
+		log(LogLevel.debug, "Scanned \"%s\"" % self.directory)
+		if len(songs) == 0:
 			raise Playlist.EmptyDirectory(self.directory)
+		self.songs = songs
+		self.lastRefresh = monotonic()
+		if Catalog.enabled:
+			Catalog.storePlaylist(self)
+	def createSongs(self, files):
+		fields = Order.tagFields(self.playOrder)
+		if len(fields) == 0:
+			# tags are not needed for sorting, so they are read only when a song is played
+			return SongList.fromPaths(self.directory + file for file in files)
+
+		tagIndex = TagIndex(self.directory)
+		songs = SongList(Scanner.map(lambda file: tagIndex.song(file, fields), files))
+		tagIndex.save(set(file for _, directoryFiles, _ in self.scannedDirectories.values() for file in directoryFiles))
+		return songs
+
+	def scanDirectory(self, relativeDirectory):
+		# the mtime is read before listing, so that changes made while listing are found by the next refresh
+		mtime = os.stat(self.directory + relativeDirectory).st_mtime_ns
+		files, subdirectories = [], []
+		with os.scandir(self.directory + relativeDirectory) as entries:
+			for entry in entries:
+				if entry.is_dir(follow_symlinks=False):
+					if Options.recursive:
+						subdirectories.append(relativeDirectory + entry.name + "/")
+				elif entry.name[-4:] == ".mp3":
+					files.append(relativeDirectory + entry.name)
+		self.scannedDirectories[relativeDirectory] = (mtime, files, subdirectories)
+	def scanTree(self, relativeDirectory):
+		files = []
+		pending = [relativeDirectory]
+		while len(pending) > 0:
+			relativeDirectory = pending.pop(0)
+			self.scanDirectory(relativeDirectory)
+			_, directoryFiles, subdirectories = self.scannedDirectories[relativeDirectory]
+			files += directoryFiles
+			pending += subdirectories
+		return files
+	def forgetTree(self, relativeDirectory):
+		files = []
+		for scannedDirectory in list(self.scannedDirectories):
+			if scannedDirectory.startswith(relativeDirectory):
+				files += self.scannedDirectories.pop(scannedDirectory)[1]
+		return files
+
+	def refresh(self):
+		# only the directories whose mtime changed are listed again, and only the songs that were
+		# added or removed are read or dropped, leaving the order of the other ones untouched
+		if len(self.scannedDirectories) == 0 or monotonic() - self.lastRefresh < RESCAN_INTERVAL:
+			return
+		self.lastRefresh = monotonic()
+
+		changedDirectories = []
+		for relativeDirectory, (mtime, _, _) in self.scannedDirectories.items():
+			try:
+				if os.stat(self.directory + relativeDirectory).st_mtime_ns != mtime:
+					changedDirectories.append(relativeDirectory)
+			except FileNotFoundError:
+				changedDirectories.append(relativeDirectory)
+		if len(changedDirectories) == 0:
+			return
+
+		addedFiles, removedFiles = [], set()
+		for relativeDirectory in changedDirectories:
+			if relativeDirectory not in self.scannedDirectories:
+				continue # already forgotten together with its parent
+			_, oldFiles, oldSubdirectories = self.scannedDirectories[relativeDirectory]
+			try:
+				self.scanDirectory(relativeDirectory)
+			except FileNotFoundError:
+				if relativeDirectory == "":
+					log(LogLevel.warning, "Directory %s does not exist anymore" % self.directory)
+					return
+				removedFiles.update(self.forgetTree(relativeDirectory))
+				continue
+
+			_, files, subdirectories = self.scannedDirectories[relativeDirectory]
+			addedFiles += [file for file in files if file not in oldFiles]
+			removedFiles.update(file for file in oldFiles if file not in files)
+			for subdirectory in oldSubdirectories:
+				if subdirectory not in subdirectories:
+					removedFiles.update(self.forgetTree(subdirectory))
+			for subdirectory in subdirectories:
+				if subdirectory not in oldSubdirectories:
+					addedFiles += self.scanTree(subdirectory)
+
+		if len(addedFiles) == 0 and len(removedFiles) == 0:
+			# e.g. only the files of the player (like its settings) changed
+			return
+		if len(removedFiles) >= len(self.songs) and len(addedFiles) == 0:
+			log(LogLevel.warning, "All songs were removed from %s: keeping the old ones" % self.directory)
+			return
+		position = self.currentSong
+		playingSong = self.songAt(position) if self.permutation is not None and 0 <= position < len(self.songs) else None
+		if len(removedFiles) > 0:
+			removedPaths = set(self.directory + file for file in removedFiles)
+			songs = []
+			for i, song in enumerate(self.songs):
+				if song.path in removedPaths:
+					if i <= self.currentSong:
+						self.currentSong -= 1
+				else:
+					songs.append(song)
+			self.songs[:] = songs
+		addedSongs = self.createSongs(addedFiles)
+		if Duplicates.mode == "collapse":
+			addedSongs = Duplicates.collapse(addedSongs, Duplicates.hashes(self.songs))
+		for song in addedSongs:
+			insertSong(self, song)
+		self.orderChanged = True
+		if self.permutation is not None:
+			# the permutation depends on the number of songs, so the playing song has to be found again
+			self.permutation = SeededPermutation(len(self.songs), self.seed)
+			if playingSong is not None and playingSong in self.songs:
+				self.currentSong = self.permutation.inverse(self.songs.index(playingSong))
+			else:
+				self.currentSong = position % len(self.songs)
+		if Catalog.enabled:
+			Catalog.invalidate(self)
+		log(LogLevel.debug, "Found %d new and %d removed songs in \"%s\"" % (len(addedFiles), len(removedFiles), self.directory))
 	def writeSettings(self):
-		with open(self.directory + SETTINGS_FILENAME, "w") as settingsFile:
-			if self.playOrder == Order.random:
-				settingsFile.write("%s\n%s" % (self.playOrder.value, 0))
+		# the order is written first, since the saved position refers to it
+		if Options.keepOrder and self.isLoaded() and self.orderChanged:
+			self.writeOrder()
+		currentSong = 0 if self.playOrder in [Order.random, Order.weighted] and not Options.keepOrder else self.resumePosition()
+		settings = "%s\n%s" % (Order.toCode(self.playOrder), currentSong)
+		if self.seed is not None:
+			settings += "\n%s" % self.seed
+		writeFileAtomically(self.settingsFilename(), settings)
+	def export(self, filename):
+		self.load()
+		songs = list(self.songs)
+		start = self.resumePosition()
+		positions = ((start + i) % len(songs) for i in range(len(songs)))
+		writeFileAtomically(filename, playlistFileLines(songs, positions if self.permutation is None
+			else (self.permutation[position] for position in positions)))
+
+	def positionOf(self, song):
+		# the position song would be played at, or None if it is not in the playlist
+		path = song.path
+		index = next((i for i, songId in enumerate(self.songs.ids) if songId == song.id or SongStore.path(songId) == path), None)
+		if index is None or self.permutation is None:
+			return index
+		return self.permutation.inverse(index)
+	def location(self):
+		return self.directory
+	def settingsFilename(self):
+		return self.directory + SETTINGS_FILENAME
+	def orderFilename(self):
+		return self.directory + ORDER_FILENAME
+	def relativeFilename(self, song):
+		return song.path[len(self.directory):]
+
+	def loadSeed(self):
+		try:
+			with open(self.settingsFilename()) as settingsFile:
+				filePlayOrder = Order.cast(settingsFile.readline().strip())
+				settingsFile.readline()
+				fileSeed = settingsFile.readline().strip()
+			if filePlayOrder is not None and filePlayOrder & Order.seededRandom:
+				return int(fileSeed)
+		except (FileNotFoundError, ValueError): pass
+		return None
+
+	@staticmethod
+	def orderFingerprint(files):
+		import hashlib
+		return hashlib.sha1("\n".join(sorted(files)).encode("utf-8", "surrogateescape")).hexdigest()
+	def writeOrder(self):
+		# the order is saved as the position of every song among the songs sorted by path, so that it
+		# takes 4 bytes per song, and is only used again if the same songs are found in the directory
+		self.orderChanged = False
+		files = [self.relativeFilename(song) for song in list(self.songs)]
+		sortedIndices = {file: i for i, file in enumerate(sorted(files))}
+		indices = array("I", (sortedIndices[file] for file in files))
+		if sys.byteorder == "big":
+			indices.byteswap()
+		writeFileAtomically(self.orderFilename(),
+			("%s %s %d\n" % (self.orderFingerprint(files), self.playOrder.value, len(files))).encode() + zlib.compress(indices.tobytes()))
+	def loadOrder(self, files):
+		# returns the files in the saved order, or None if the songs or the play order changed
+		try:
+			with open(self.orderFilename(), "rb") as orderFile:
+				fingerprint, playOrder, length = orderFile.readline().decode().split()
+				indices = array("I")
+				indices.frombytes(zlib.decompress(orderFile.read()))
+		except (OSError, ValueError, zlib.error):
+			return None
+		if sys.byteorder == "big":
+			indices.byteswap()
+
+		if int(playOrder) != self.playOrder.value or int(length) != len(files) or len(indices) != len(files) \
+				or fingerprint != self.orderFingerprint(files):
+			return None
+		sortedFiles = sorted(files)
+		try:
+			return [sortedFiles[i] for i in indices]
+		except IndexError:
+			return None
+
+class M3uPlaylist(Playlist):
+	# the songs listed in an M3U/M3U8 file, which is read one line at a time. Unless they have to be
+	# sorted by their tags, the tags of songs are read only when they are played
+	defaultPlayOrder = Order.listed
+
+	def __init__(self, filename, playOrder = None, startSong = None):
+		self.filename = filename
+		Playlist.__init__(self, os.path.dirname(os.path.abspath(filename)), playOrder, startSong)
+		self.name = os.path.basename(filename)
+
+	@staticmethod
+	def isPlaylistFile(path):
+		return os.path.splitext(path)[1].lower() in PLAYLIST_FILE_EXTENSIONS and os.path.isfile(path)
+
+	def location(self):
+		return self.filename
+	def settingsFilename(self):
+		return "%s-%s" % (self.filename, SETTINGS_FILENAME)
+	def orderFilename(self):
+		return "%s-%s" % (self.filename, ORDER_FILENAME)
+	def relativeFilename(self, song):
+		return song.path
+
+	def paths(self):
+		# relative paths are relative to the directory of the file
+		with open(self.filename, encoding="utf-8-sig", errors="surrogateescape") as playlistFile:
+			for line in playlistFile:
+				line = line.strip()
+				if line == "" or line[0] == "#":
+					continue
+				if line.startswith("file://"):
+					from urllib.parse import unquote
+					line = unquote(line[len("file://"):], errors="surrogateescape")
+				elif "://" in line:
+					log(LogLevel.debug, "Skipping \"%s\" in \"%s\": not a local file" % (line, self.filename))
+					continue
+				yield os.path.normpath(os.path.join(self.directory, line))
+
+	def loadSongs(self):
+		with Profiler.measure("readPlaylistFile %s" % self.filename):
+			paths = list(self.paths())
+		if len(paths) == 0:
+			raise Playlist.EmptyDirectory(self.filename)
+		if Options.keepOrder:
+			orderedPaths = self.loadOrder(paths)
+			if orderedPaths is not None:
+				paths = orderedPaths
+				self.materialized = True
+
+		self.songs = SongList.fromPaths(paths)
+		if not self.materialized and sortKey(self.playOrder) is not None:
+			fields = Order.tagFields(self.playOrder)
+			if len(fields) > 0:
+				Scanner.map(lambda song: song.readTags(fields), self.songs)
+		log(LogLevel.debug, "Read %d songs from \"%s\"" % (len(paths), self.filename))
+
+class MergedPlaylist:
+	# all playlists merged into a single one sorted by the same key, without copying their songs
+	# together: like in a k-way merge, every song is taken from the playlist whose next song comes
+	# first. The merge state is the number of songs taken from every playlist before the cursor,
+	# which is moved one song at a time, or found again with binary searches when jumping far
+	MAX_WALK = 64
+
+	def __init__(self, playlists, playOrder = None):
+		self.playlists = playlists
+		self.loadLock = threading.Lock()
+		self.playing = False
+		# the songs of every playlist sorted by the key, see load()
+		self.sources = None
+
+		self.playOrder = Order.cast(playOrder)
+		if playOrder is not None and self.playOrder is None:
+			raise RuntimeError("Invalid play order \"%s\" for merged playlists of type \"%s\"" % (playOrder, type(playOrder)))
+		self.currentSong = None
+		try:
+			with open(MERGED_SETTINGS_FILENAME) as settingsFile:
+				filePlayOrder = settingsFile.readline().strip()
+				fileStartSong = settingsFile.readline().strip()
+				if self.playOrder is None:
+					self.playOrder = Order.cast(filePlayOrder)
+				if self.playOrder == Order.cast(filePlayOrder):
+					try: self.currentSong = int(fileStartSong)
+					except ValueError: pass
+		except FileNotFoundError: pass
+		if self.playOrder is None:
+			self.playOrder = Order.default
+		if self.currentSong is None:
+			self.currentSong = 0
+		if sortKey(self.playOrder) is None or self.playOrder & (Order.seededRandom | Order.modified | Order.distributed):
+			raise RuntimeError("Invalid play order \"%s\" for merged playlists: only path, title, artist and track number can be merged" % Order.toString(self.playOrder))
+		self.key = sortKey(self.playOrder)
+		if playOrder is not None:
+			Settings.markDirty(self)
+
+	def __iter__(self):
+		return self
+	def __next__(self):
+		self.load()
+		self.currentSong += 1
+		self.currentSong %= len(self)
+		Settings.markDirty(self)
+		return self.songAt(self.currentSong)
+	def __len__(self):
+		self.load()
+		return sum(len(songs) for songs in self.sources)
+	def peek(self):
+		return self.songAt((self.currentSong + 1) % len(self))
+	def upcoming(self, count):
+		length = len(self)
+		return [self.songAt((self.currentSong + i) % length) for i in range(1, min(count, length - 1) + 1)]
+	def songAt(self, position):
+		self.seek(position)
+		return Song.fromId(self.take())
+
+	def take(self):
+		# the id of the song at the cursor, moving the cursor after it; ties go to the first playlist
+		best, bestKey = None, None
+		for i, songs in enumerate(self.sources):
+			if self.offsets[i] < len(songs.ids):
+				key = self.key(songs.ids[self.offsets[i]])
+				if best is None or key < bestKey:
+					best, bestKey = i, key
+		self.offsets[best] += 1
+		self.cursor += 1
+		return self.sources[best].ids[self.offsets[best] - 1]
+	def takeBack(self):
+		# moves the cursor before the song preceding it
+		best, bestKey = None, None
+		for i, songs in enumerate(self.sources):
+			if self.offsets[i] > 0:
+				key = self.key(songs.ids[self.offsets[i] - 1])
+				if best is None or key >= bestKey:
+					best, bestKey = i, key
+		self.offsets[best] -= 1
+		self.cursor -= 1
+	def seek(self, position):
+		self.load()
+		lengths = [len(songs) for songs in self.sources]
+		if lengths != self.lengths or abs(position - self.cursor) > self.MAX_WALK:
+			# songs were added to or removed from some playlist while it was being played
+			self.lengths = lengths
+			self.select(position)
+		while self.cursor < position:
+			self.take()
+		while self.cursor > position:
+			self.takeBack()
+
+	def countBefore(self, source, key, inclusive):
+		# the number of songs of the source whose key is lower than key (or equal, if inclusive)
+		ids = self.sources[source].ids
+		low, high = 0, len(ids)
+		while low < high:
+			middle = (low + high) // 2
+			middleKey = self.key(ids[middle])
+			if middleKey < key or (inclusive and middleKey == key):
+				low = middle + 1
 			else:
-				settingsFile.write("%s\n%s" % (self.playOrder.value, self.currentSong))
+				high = middle
+		return low
+	def offsetsBefore(self, source, offset):
+		# the merge state right before the song at offset in the source
+		key = self.key(self.sources[source].ids[offset])
+		return [offset if i == source else self.countBefore(i, key, i < source) for i in range(len(self.sources))]
+	def select(self, position):
+		# finds the song at the position with a binary search in every playlist, since the position
+		# of a song in the merged playlist grows with its position in its own playlist
+		if position >= len(self):
+			self.offsets, self.cursor = [len(songs) for songs in self.sources], len(self)
+			return
+		for source, songs in enumerate(self.sources):
+			low, high = 0, len(songs)
+			while low < high:
+				middle = (low + high) // 2
+				if sum(self.offsetsBefore(source, middle)) < position:
+					low = middle + 1
+				else:
+					high = middle
+			if low < len(songs):
+				offsets = self.offsetsBefore(source, low)
+				if sum(offsets) == position:
+					self.offsets, self.cursor = offsets, position
+					return
+		raise RuntimeError("Unable to find song %d of the merged playlists" % position)
+
+	def move(self, delta):
+		self.currentSong += delta
+		Settings.markDirty(self)
+	def setPos(self, value):
+		self.currentSong = value
+		Settings.markDirty(self)
+	def pos(self):
+		return self.currentSong
+	def setPlaying(self, playing):
+		self.playing = playing
+		Settings.markDirty(self)
+	def resumePosition(self):
+		if not self.isLoaded():
+			return self.currentSong
+		# when not playing, __next__ has still to be called for the song to resume from
+		return (self.currentSong if self.playing else self.currentSong + 1) % len(self)
+
+	def isLoaded(self):
+		return self.sources is not None
+	def load(self):
+		with self.loadLock:
+			if self.isLoaded():
+				return
+			sources = []
+			for playlist in self.playlists:
+				try:
+					playlist.load()
+				except Playlist.EmptyDirectory:
+					continue
+				if not playlist.materialized and sortKey(playlist.playOrder) == self.key \
+						and not playlist.playOrder & (Order.modified | Order.distributed):
+					# already sorted by the key, and kept sorted when songs are added
+					sources.append(playlist.songs)
+				else:
+					fields = Order.tagFields(self.playOrder)
+					Scanner.map(lambda song: song.readTags(fields), playlist.songs)
+					sources.append(SongList.fromIds(array("I", sorted(playlist.songs.ids, key = self.key))))
+			if len(sources) == 0:
+				raise Playlist.EmptyDirectory(self.location())
+			self.offsets, self.cursor = [0] * len(sources), 0
+			self.lengths = [len(songs) for songs in sources]
+			self.sources = sources
+			# this is done since __next__ does += 1 even the first time
+			self.currentSong -= 1
+
+	def writeSettings(self):
+		writeFileAtomically(MERGED_SETTINGS_FILENAME, "%s\n%s" % (Order.toCode(self.playOrder), self.resumePosition()))
+	def export(self, filename):
+		start, length = self.resumePosition(), len(self)
+		songs = [self.songAt((start + i) % length) for i in range(length)]
+		writeFileAtomically(filename, playlistFileLines(songs, range(length)))
+	def positionOf(self, song):
+		self.load()
+		path = song.path
+		for source, songs in enumerate(self.sources):
+			offset = next((i for i, songId in enumerate(songs.ids) if songId == song.id or SongStore.path(songId) == path), None)
+			if offset is not None:
+				return sum(self.offsetsBefore(source, offset))
+		return None
+	def location(self):
+		return "all playlists"
+
+class SearchIndex:
+	# finds songs of all playlists by title, artist and path: every word of the query must be found
+	# in one of them. Words of at least 3 characters are looked up in an index of the trigrams of
+	# the text of every song, shorter ones in the sorted list of all the words of the texts, by prefix
+	def __init__(self, entries):
+		# (playlist, song) pairs
+		self.entries = entries
+		self.texts = []
+		self.trigrams = {}
+		words = set()
+		for i, (playlist, song) in enumerate(entries):
+			text = ("%s %s %s" % ("".join(song.tags.get("artist", [])), "".join(song.tags.get("title", [])), song.path)).lower()
+			self.texts.append(text)
+			for trigram in set(text[j:j+3] for j in range(len(text) - 2)):
+				self.trigrams.setdefault(trigram, array("I")).append(i)
+			words.update((word, i) for word in text.replace("/", " ").split())
+		self.words = sorted(words)
+
+	def matching(self, word):
+		if len(word) >= 3:
+			postings = sorted((self.trigrams.get(word[j:j+3], ()) for j in range(len(word) - 2)), key=len)
+			indices = set(postings[0])
+			for posting in postings[1:]:
+				indices.intersection_update(posting)
+			return set(i for i in indices if word in self.texts[i])
+		start = bisect.bisect_left(self.words, (word,))
+		end = bisect.bisect_left(self.words, (word + chr(0x10ffff),))
+		return set(i for _, i in self.words[start:end])
+
+	def search(self, query, limit):
+		words = query.lower().split()
+		if len(words) == 0:
+			return []
+		indices = self.matching(words[0])
+		for word in words[1:]:
+			indices &= self.matching(word)
+		return [self.entries[i] for i in sorted(indices)[:limit]]
 
 class PlaylistsPlayer:
 	class Event(Enum):
@@ -580,6 +2913,12 @@ class PlaylistsPlayer:
 		prev = 1
 		save = 2
 		abort = 3
+		jump = 4
+
+	searchIndex = None
+	searchIndexKey = None
+	# the playlist and the position chosen in the search, see search()
+	jumpTarget = None
 
 	def __init__(self, playlists):
 		self.playlists = playlists
@@ -587,43 +2926,67 @@ class PlaylistsPlayer:
 
 	@classmethod
 	def playPlaylist(cls, playlist):
+		skippedDuplicates = 0
 		for song in playlist:
-			player = vlc.MediaPlayer(song.path)
-			player.play()
+			if Duplicates.mode == "skip" and Duplicates.playedElsewhere(song):
+				# unless all songs of the playlist were already played from other files
+				skippedDuplicates += 1
+				if skippedDuplicates < len(playlist):
+					log(LogLevel.debug, "Skipping song at \"%s\": already played from another file" % song.path)
+					continue
+			skippedDuplicates = 0
+			player = SongPlayer.play(song)
 			log(LogLevel.info,
 				(("❤" if Favourites.isFavourite(song) else " ") + "  %s%d/%d: %s")
 				% (" " * (len(str(len(playlist))) - len(str(playlist.pos() + 1))), playlist.pos() + 1, len(playlist), song))
+			ControlServer.notify("song", position=playlist.pos(), songs=len(playlist), path=song.path, name=repr(song),
+				favourite=Favourites.isFavourite(song))
+			SongPlayer.prepare(playlist.peek())
+			ReadAhead.request(playlist)
 			paused = False
 
-			while player.get_state() != vlc.State.Ended:
-				sleep(0.1)
+			while 1:
+				Keyboard.wait(PlayerEvents)
+				playerEvent = PlayerEvents.pop(player)
+				if playerEvent == PlayerEvents.Event.ended:
+					Profiler.startLatency("trackTransition")
+					History.record("p", song)
+					break
+				elif playerEvent == PlayerEvents.Event.error:
+					log(LogLevel.warning, "Unable to play song at \"%s\"" % song.path)
+					break
 
 				nextAction = Keyboard.getEvent()
+				if nextAction in [Event.restart, Event.nextSong, Event.prevSong, Event.nextPlaylist, Event.prevPlaylist]:
+					Profiler.startLatency("keyToAudio")
 				if nextAction == Event.abort:
 					log(LogLevel.info, "Aborting...")
 					return cls.Event.abort
 				elif nextAction == Event.save:
 					log(LogLevel.info, "Saving...")
+					# moving by -1 since __next__ does += 1, so that the same song is played next time
+					playlist.move(-1)
 					return cls.Event.save
 				elif nextAction == Event.pause:
 					player.pause()
 					paused = not paused
 					if paused: log(LogLevel.info, "Pause")
 					else: log(LogLevel.info, "Resume")
+					ControlServer.notify("pause", paused=paused)
 				elif nextAction == Event.restart:
 					player.stop()
 					# setting to -1 since __next__ does += 1
 					playlist.setPos(-1)
 					log(LogLevel.info, "Restart")
 					break
-				elif nextAction == Event.nextSong:
-					player.stop()
-					# __next__ does += 1
-					break
-				elif nextAction == Event.prevSong:
+				elif nextAction in [Event.nextSong, Event.prevSong]:
+					delta = cls.countSkips(nextAction)
+					if delta == 0:
+						continue
 					player.stop()
-					# moving by -2 since __next__ does += 1
-					playlist.move(-2)
+					History.record("s", song)
+					# moving by one less since __next__ does += 1
+					playlist.move(delta - 1)
 					break
 				elif nextAction == Event.nextPlaylist:
 					player.stop()
@@ -638,7 +3001,9 @@ class PlaylistsPlayer:
 				elif nextAction == Event.favourite:
 					if Favourites.isFavourite(song):
 						Favourites.remove(song)
+						History.record("-", song)
 						log(LogLevel.info, "Removed favourite: %s" % song)
+						ControlServer.notify("favourite", path=song.path, favourite=False)
 						if type(playlist) is Favourites:
 							player.stop()
 							# moving by -1 since __next__ does += 1
@@ -646,28 +3011,172 @@ class PlaylistsPlayer:
 							break
 					else:
 						Favourites.add(song)
+						History.record("+", song)
 						log(LogLevel.info, "New favourite: %s" % song)
+						ControlServer.notify("favourite", path=song.path, favourite=True)
+				elif nextAction == Event.search:
+					target = cls.search()
+					if target is not None:
+						player.stop()
+						# moving by -1 since __next__ does += 1
+						playlist.move(-1)
+						cls.jumpTarget = target
+						return cls.Event.jump
+				elif nextAction == Event.export:
+					try:
+						playlist.export(EXPORT_FILENAME)
+						log(LogLevel.info, "Exported playlist to \"%s\"" % EXPORT_FILENAME)
+					except OSError as e:
+						log(LogLevel.warning, "Unable to export playlist: %s" % e)
 
 		return cls.Event.next
 
+	@staticmethod
+	def countSkips(event):
+		# held keys repeat quickly: the next and previous song keys pressed within a short time
+		# of each other are added up, so that only the song they lead to gets a player
+		delta = 1 if event == Event.nextSong else -1
+		while Keyboard.waitForKey(Options.keyRepeatWindow):
+			key = Keyboard.getKey()
+			event = Event.none if key is None else Event.generate(key)
+			if event == Event.nextSong:
+				delta += 1
+			elif event == Event.prevSong:
+				delta -= 1
+			elif event != Event.none:
+				Keyboard.putBack(key)
+				break
+		return delta
+
+	@classmethod
+	def buildSearchIndex(cls):
+		# the index is built again only if songs were added to or removed from some playlist
+		playlists = []
+		for playlist in Options.playlists:
+			if isinstance(playlist, MergedPlaylist):
+				# its songs are the ones of the other playlists
+				continue
+			try:
+				playlist.load()
+				playlists.append(playlist)
+			except Playlist.EmptyDirectory:
+				pass
+		key = [(id(playlist), len(playlist.songs)) for playlist in playlists]
+		if cls.searchIndex is not None and key == cls.searchIndexKey:
+			return cls.searchIndex
+
+		log(LogLevel.info, "Indexing songs...")
+		with Profiler.measure("buildSearchIndex"):
+			entries = [(playlist, song) for playlist in playlists for song in list(playlist.songs)]
+			Scanner.map(lambda song: song.readTags(["title", "artist"]), [song for _, song in entries])
+			cls.searchIndex = SearchIndex(entries)
+		cls.searchIndexKey = key
+		return cls.searchIndex
+	@classmethod
+	def search(cls):
+		# returns the playlist and the position of the chosen song, or None if the search was cancelled
+		index = cls.buildSearchIndex()
+		query, selected, results = "", 0, []
+		while 1:
+			if len(query) == 0:
+				line = "Search: "
+			elif len(results) == 0:
+				line = "Search: %s (no results)" % query
+			else:
+				playlist, song = results[selected]
+				line = "Search: %s (%d/%d%s) %s" % (query, selected + 1, len(results), "+" if len(results) == SEARCH_RESULTS else "",
+					repr(song))
+			log(LogLevel.info, "\r\x1B[K" + line, end="", flush=True)
+
+			Keyboard.waitForKey()
+			key = Keyboard.getKey()
+			if key is None:
+				continue
+			elif key == '\n' and len(results) > 0:
+				log(LogLevel.info, "")
+				playlist, song = results[selected]
+				return (playlist, playlist.positionOf(song))
+			elif key == '\x1B' or key == '\n':
+				log(LogLevel.info, "")
+				return None
+			elif key in NEXT_SONG_KEYS:
+				selected = (selected + 1) % max(len(results), 1)
+				continue
+			elif key in PREV_SONG_KEYS:
+				selected = (selected - 1) % max(len(results), 1)
+				continue
+			elif key == '\x7F' or key == '\x08':
+				query = query[:-1]
+			elif len(key) == 1 and key.isprintable():
+				query += key
+			else:
+				continue
+			results = index.search(query, SEARCH_RESULTS)
+			selected = 0
+
+	def preload(self):
+		for playlist in self.playlists[:]:
+			try:
+				playlist.load()
+			except Playlist.EmptyDirectory:
+				# the playlist is removed by play() when it is reached
+				continue
+			if Duplicates.mode == "skip" and not isinstance(playlist, MergedPlaylist):
+				# songs are skipped only once their hash is known, so that playing never waits for it
+				Duplicates.hashes(playlist.songs)
+
 	def play(self):
 		nrPlaylists = len(self.playlists)
 		if nrPlaylists == 0:
 			return
 
+		preloadStarted = False
+		event = PlaylistsPlayer.Event.next
 		while 1:
-			if type(self.playlists[self.currentPlaylist]) is Playlist:
+			try:
+				self.playlists[self.currentPlaylist].load()
+			except Playlist.EmptyDirectory as e:
+				log(LogLevel.warning, e.what())
+				del self.playlists[self.currentPlaylist]
+				nrPlaylists -= 1
+				if nrPlaylists == 0:
+					return
+				if event == PlaylistsPlayer.Event.prev:
+					self.currentPlaylist -= 1
+				self.currentPlaylist %= nrPlaylists
+				continue
+
+			if (Options.preloadPlaylists or Duplicates.mode == "skip") and not preloadStarted:
+				threading.Thread(target=self.preload, daemon=True).start()
+				preloadStarted = True
+
+			if isinstance(self.playlists[self.currentPlaylist], Playlist):
 				log(LogLevel.info, 'Now playing playlist at "%s", sorted by %s' % (
-					self.playlists[self.currentPlaylist].directory,
+					self.playlists[self.currentPlaylist].location(),
+					Order.toString(self.playlists[self.currentPlaylist].playOrder)))
+			elif isinstance(self.playlists[self.currentPlaylist], MergedPlaylist):
+				log(LogLevel.info, 'Now playing all playlists, sorted by %s' % (
 					Order.toString(self.playlists[self.currentPlaylist].playOrder)))
 			else:
 				log(LogLevel.info, 'Now playing favourites, sorted by %s' % (
 					Order.toString(self.playlists[self.currentPlaylist].playOrder)))
+			ControlServer.notify("playlist", index=self.currentPlaylist, playlists=nrPlaylists,
+				location=None if type(self.playlists[self.currentPlaylist]) is Favourites else self.playlists[self.currentPlaylist].location(),
+				order=Order.toString(self.playlists[self.currentPlaylist].playOrder))
+			ReadAhead.nextPlaylist = self.playlists[(self.currentPlaylist + 1) % nrPlaylists]
+			self.playlists[self.currentPlaylist].setPlaying(True)
 			event = PlaylistsPlayer.playPlaylist(self.playlists[self.currentPlaylist])
+			self.playlists[self.currentPlaylist].setPlaying(False)
 			if event == PlaylistsPlayer.Event.next:
 				self.currentPlaylist += 1
 			elif event == PlaylistsPlayer.Event.prev:
 				self.currentPlaylist -= 1
+			elif event == PlaylistsPlayer.Event.jump:
+				playlist, position = PlaylistsPlayer.jumpTarget
+				if playlist in self.playlists and position is not None:
+					self.currentPlaylist = self.playlists.index(playlist)
+					# __next__ does += 1
+					playlist.setPos(position - 1)
 			elif event == PlaylistsPlayer.Event.save:
 				self.save()
 				return
@@ -679,13 +3188,15 @@ class PlaylistsPlayer:
 			while self.currentPlaylist < 0:
 				self.currentPlaylist += nrPlaylists
 	def save(self):
-		for playlist in self.playlists:
-			playlist.writeSettings()
+		Settings.flush()
+		if Favourites.journalLength > 0:
+			Favourites.compact()
 
 
 def main(arguments):
 	#arguments parsing
 	Options.parse(arguments)
+	Keyboard.init()
 
 	#playing songs
 	player = PlaylistsPlayer(Options.playlists)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# Checks that the distributed order, which samples songs from RemainingIndices, is distributed like
+# the original sampler, which popped the indices from a Python list. Run it with:
+#   python3 -m unittest discover tests
+
+import os
+import math
+import random
+import unittest
+import importlib.util
+from array import array
+from types import SimpleNamespace
+
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mp3-player", "mp3-player.py")
+SHUFFLES = 20000
+SONGS = 20
+Z_SCORE = 3.09 # one sided p = 0.001
+
+def loadPlayer():
+	spec = importlib.util.spec_from_file_location("mp3player", SCRIPT_PATH)
+	player = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(player)
+	return player
+
+player = loadPlayer()
+
+
+def distributedReference(songs):
+	# the sampler used before RemainingIndices, which is quadratic
+	indices = list(range(len(songs)))
+	copiedPlaylist = []
+	while len(indices) > 0:
+		exponent = min(8 / len(indices), 1)
+		random_var_squared = random.uniform(1, (len(indices) + 0.99) ** exponent)
+		random_var = int(random_var_squared ** (1/exponent) - 1)
+		copiedPlaylist.append(songs[indices.pop(random_var)])
+	return copiedPlaylist
+
+def distributed(songs):
+	playlist = SimpleNamespace(playOrder=player.Order.distributed, songs=player.SongList.fromIds(array("I", songs)))
+	player.sortPlaylist(playlist)
+	return list(playlist.songs.ids)
+
+def counts(sampler, seed):
+	# how many times every song ended up at every position
+	random.seed(seed)
+	counts = [[0] * SONGS for _ in range(SONGS)]
+	for _ in range(SHUFFLES):
+		for position, song in enumerate(sampler(list(range(SONGS)))):
+			counts[position][song] += 1
+	return counts
+
+def chiSquareCritical(degreesOfFreedom, z):
+	# Wilson-Hilferty approximation of the chi-square quantile
+	h = 2 / (9 * degreesOfFreedom)
+	return degreesOfFreedom * (1 - h + z * math.sqrt(h)) ** 3
+
+
+class DistributedOrderTest(unittest.TestCase):
+	def testSameSequenceWithSameSeed(self):
+		for size in [1, 2, 9, 50, 333]:
+			for seed in range(5):
+				random.seed(seed)
+				expected = distributedReference(list(range(size)))
+				random.seed(seed)
+				self.assertEqual(distributed(list(range(size))), expected, "size %d, seed %d" % (size, seed))
+
+	def testSameDistribution(self):
+		# chi-square test of homogeneity of the (position, song) counts of the two samplers, with
+		# different seeds so that the samples are independent
+		expected, actual = counts(distributedReference, 1), counts(distributed, 2)
+		chiSquare, cells = 0, 0
+		for expectedRow, actualRow in zip(expected, actual):
+			for a, b in zip(expectedRow, actualRow):
+				if a + b > 0:
+					chiSquare += (a - b) ** 2 / (a + b)
+					cells += 1
+		self.assertLess(chiSquare, chiSquareCritical(cells - 1, Z_SCORE))
+
+
+if __name__ == '__main__':
+	unittest.main()